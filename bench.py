@@ -0,0 +1,285 @@
+"""Throughput benchmark for the bot against a local fake Bot API.
+
+Boots the Application the same way ``main()`` does (``parse_args`` +
+``build_application`` + the post_init/post_stop/post_shutdown hooks), points
+it at an in-process fake Bot API and replays synthetic updates through
+``Application.process_update``. Every run happens in a fresh temporary
+directory so the real users/configs are never touched.
+
+    python bench.py
+    python bench.py --users 20000 --broadcast-users 100000 --api-latency 20
+    python bench.py --workloads start,qr --json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import socket
+import resource
+import tempfile
+import tracemalloc
+
+WORKLOADS = ('start', 'browse', 'qr', 'ping', 'broadcast')
+BROWSE_CALLBACKS = ('servers', 'tools', 'faq', 'faq_0', 'clients', 'sublink', 'back')
+FIRST_USER_ID = 10_000_000
+
+
+def parse_bench_args(argv=None):
+    parser = argparse.ArgumentParser(description="Azadi-Net bot benchmark")
+    parser.add_argument('--workloads', default=','.join(WORKLOADS),
+                        help=f"Comma-separated subset of: {', '.join(WORKLOADS)}")
+    parser.add_argument('--users', type=int, default=5000, help="Updates per handler workload")
+    parser.add_argument('--broadcast-users', type=int, default=100_000)
+    parser.add_argument('--concurrency', type=int, default=64, help="Updates in flight at once")
+    parser.add_argument('--configs', type=int, default=8, help="Configs served by the fake catalog")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="Fake Bot API latency in ms")
+    parser.add_argument('--storage', default='sqlite', choices=('json', 'journal', 'sqlite'))
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help="Report Python heap growth per workload (slows the run down)")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON")
+    return parser.parse_args(argv)
+
+
+class FakeBotApi:
+    """Answers every Bot API method with a plausible result and counts the calls."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = {}
+        self._message_id = 0
+
+    def _message(self, **extra) -> dict:
+        self._message_id += 1
+        message = {'message_id': self._message_id, 'date': int(time.time()),
+                   'chat': {'id': 1, 'type': 'private'}}
+        message.update(extra)
+        return message
+
+    def result_for(self, method: str):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        if method == 'sendPhoto':
+            return self._message(photo=[{'file_id': f'photo-{self._message_id}', 'file_unique_id': 'u',
+                                         'width': 370, 'height': 370}])
+        if method == 'sendDocument':
+            return self._message(document={'file_id': 'doc', 'file_unique_id': 'u'})
+        if method in ('sendMessage', 'editMessageText'):
+            return self._message(text='ok')
+        return True
+
+    async def __call__(self, request):
+        method = request.path.rsplit('/', 1)[-1]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        body = json.dumps({'ok': True, 'result': self.result_for(method)}).encode()
+        return 200, {'Content-Type': 'application/json'}, body
+
+
+def _user(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f'u{user_id}', 'language_code': 'fa'}
+
+
+def start_update(update_id: int, user_id: int) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'}, 'from': _user(user_id),
+            'text': '/start', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    }
+
+
+def callback_update(update_id: int, user_id: int, data: str) -> dict:
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id), 'from': _user(user_id), 'chat_instance': str(user_id), 'data': data,
+            'message': {'message_id': update_id, 'date': int(time.time()),
+                        'chat': {'id': user_id, 'type': 'private'}, 'text': 'menu'},
+        },
+    }
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def max_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux and bytes on macOS.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+class Bench:
+    def __init__(self, bot_module, application, fake_api: FakeBotApi, options):
+        self.bot = bot_module
+        self.application = application
+        self.fake_api = fake_api
+        self.options = options
+        self.results = []
+        self._next_update_id = 1
+
+    def update_ids(self, count: int) -> range:
+        start = self._next_update_id
+        self._next_update_id += count
+        return range(start, start + count)
+
+    async def replay(self, name: str, payloads: list) -> None:
+        from telegram import Update
+
+        semaphore = asyncio.Semaphore(self.options.concurrency)
+        latencies = []
+
+        async def one(payload):
+            async with semaphore:
+                update = Update.de_json(payload, self.application.bot)
+                started = time.perf_counter()
+                await self.application.process_update(update)
+                latencies.append(time.perf_counter() - started)
+
+        await self.measure(name, len(payloads), asyncio.gather(*(one(p) for p in payloads)), latencies)
+
+    async def measure(self, name: str, count: int, awaitable, latencies=None) -> None:
+        calls_before = sum(self.fake_api.calls.values())
+        if self.options.tracemalloc:
+            tracemalloc.start()
+        started = time.perf_counter()
+        await awaitable
+        elapsed = time.perf_counter() - started
+        heap_peak = None
+        if self.options.tracemalloc:
+            heap_peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            tracemalloc.stop()
+        latencies = sorted(latencies or [])
+        self.results.append({
+            'workload': name,
+            'count': count,
+            'seconds': round(elapsed, 3),
+            'per_second': round(count / elapsed, 1) if elapsed else 0.0,
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+            'api_calls': sum(self.fake_api.calls.values()) - calls_before,
+            'heap_peak_mb': round(heap_peak, 1) if heap_peak is not None else None,
+            'max_rss_mb': round(max_rss_mb(), 1),
+        })
+
+    async def workload_start(self) -> None:
+        ids = self.update_ids(self.options.users)
+        await self.replay('start', [start_update(i, FIRST_USER_ID + i) for i in ids])
+
+    async def workload_browse(self) -> None:
+        ids = self.update_ids(self.options.users)
+        payloads = [callback_update(i, FIRST_USER_ID + i, BROWSE_CALLBACKS[i % len(BROWSE_CALLBACKS)]) for i in ids]
+        await self.replay('browse', payloads)
+
+    async def workload_qr(self) -> None:
+        # Start cold: the first request per config renders and uploads, the rest reuse the file_id.
+        await self.bot.EXECUTOR.run(self.bot.QR_CACHE.retain, [])
+        self.bot.QR_FILE_IDS.clear()
+        for cfg in self.bot.CONFIGS.values():
+            await self.bot.EXECUTOR.run(self.bot.STORAGE.set_meta, f"qr_file:{self.bot.QR_CACHE.key(cfg['config'])}", None)
+        cfg_ids = list(self.bot.CONFIGS)
+        ids = self.update_ids(self.options.users)
+        payloads = [callback_update(i, FIRST_USER_ID + i, f'config_{cfg_ids[i % len(cfg_ids)]}') for i in ids]
+        await self.replay('qr', payloads)
+
+    async def workload_ping(self) -> None:
+        self.bot.HEALTH.last_checked = None
+        ids = self.update_ids(self.options.users)
+        await self.replay('ping', [callback_update(i, FIRST_USER_ID + i, 'ping_test') for i in ids])
+
+    async def workload_broadcast(self) -> None:
+        bot = self.bot
+        bot.USERS.replace(range(FIRST_USER_ID, FIRST_USER_ID + self.options.broadcast_users))
+        await bot.STATE.add_users(bot.USERS.snapshot())
+        # Measure the sending pipeline itself, not Telegram's 30 msg/s cap.
+        bot.BROADCAST_RATE = 1e9
+        bot.BROADCAST_PER_CHAT_INTERVAL = 0.0
+        broadcast = bot.Broadcast.create(self.application.bot, "bench", bot.ADMIN_ID, 1, self.options.broadcast_users)
+        await self.measure('broadcast', self.options.broadcast_users, broadcast.run())
+
+
+async def seed_configs(bot, count: int, probe_port: int) -> None:
+    for cfg_id in list(bot.CONFIGS):
+        await bot.delete_config(cfg_id)
+    for i in range(count):
+        url = f"vless://826f524a-cea1-4e44-9b49-3381d13b7593@127.0.0.1:{probe_port}?security=tls#bench-{i}"
+        await bot.save_config(f'bench_{i}', {'name': f'Bench {i}', 'config': url})
+
+
+async def run_bench(options) -> list:
+    import main as bot
+
+    fake_api = FakeBotApi(options.api_latency / 1000)
+    api_port = free_port()
+    api_server = await bot.serve_http('127.0.0.1', api_port, fake_api, max_connections=1000)
+    # Ping tests probe this port, so they measure the bot rather than the network.
+    probe_server = await asyncio.start_server(lambda r, w: w.close(), '127.0.0.1', 0)
+    probe_port = probe_server.sockets[0].getsockname()[1]
+
+    await seed_configs(bot, options.configs, probe_port)
+    args = bot.parse_args(['--token', '1:bench', '--mode', 'polling', '--base-url', f'http://127.0.0.1:{api_port}/bot'])
+    application = bot.build_application(args)
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+
+    bench = Bench(bot, application, fake_api, options)
+    try:
+        for name in options.workloads.split(','):
+            if name not in WORKLOADS:
+                raise SystemExit(f"Unknown workload: {name}")
+            await getattr(bench, f'workload_{name}')()
+    finally:
+        await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+        probe_server.close()
+        await api_server.close()
+    return bench.results
+
+
+def print_table(results: list) -> None:
+    columns = ('workload', 'count', 'seconds', 'per_second', 'p50_ms', 'p99_ms', 'api_calls', 'heap_peak_mb', 'max_rss_mb')
+    rows = [[('-' if r[c] is None else str(r[c])) for c in columns] for r in results]
+    widths = [max(len(c), *(len(row[i]) for row in rows)) for i, c in enumerate(columns)]
+    print('  '.join(c.ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(v.ljust(w) for v, w in zip(row, widths)))
+
+
+def main(argv=None) -> None:
+    options = parse_bench_args(argv)
+    workdir = tempfile.mkdtemp(prefix='azadi-bench-')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    # Set before main.py is imported: it reads its settings at import time.
+    os.environ['STORAGE_BACKEND'] = options.storage
+    os.environ['STATE_BACKEND'] = 'local'
+    os.environ['FLOOD_RATE'] = '1000000'
+    os.environ['FLOOD_BURST'] = '1000000'
+    os.environ.pop('METRICS_PORT', None)
+    results = asyncio.run(run_bench(options))
+    if options.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+        print(f"\n(data directory: {workdir})")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,519 @@
 import os
+import math
 import random
+import asyncio
+import logging
+import hashlib
+import threading
+import argparse
+import hmac
+import json
+import secrets
+import signal
+import sys
+import multiprocessing
+import importlib.util
+import contextlib
+import contextvars
+import cProfile
+import io
+import gzip
+import base64
+import tempfile
+import pstats
 import qrcode
 from io import BytesIO
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+)
+from telegram.request import HTTPXRequest
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
+    ApplicationHandlerStop,
     ContextTypes,
+    InlineQueryHandler,
     MessageHandler,
+    TypeHandler,
     filters,
 )
-import json
 import time
 import datetime
-import socket
-from urllib.parse import urlparse
-
-TOKEN = "Token"
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from storage import open_storage
+from state import open_state
+from resolver import DnsResolver
+from sharelinks import ConfigIndex, ParsedConfig, b64decode, country_flag, parse_config_url, with_link_name
+
+TOKEN = os.environ.get('BOT_TOKEN', "Token")
 ADMIN_ID = 754
 
 USERS_FILE = 'users.json'
 CONFIGS_FILE = 'configs.json'
 START_TIME = time.time()
-MESSAGE_COUNT = 0
+USERS_FLUSH_DELAY = 5.0
+# Telegram caps bot uploads at 50 MB; parts are cut below that with room for zlib's buffered tail.
+EXPORT_PART_LIMIT = int(os.environ.get('EXPORT_PART_LIMIT', str(45 * 1024 * 1024)))
+USER_SCAN_BATCH_SIZE = 10000
+BULK_IMPORT_MAX_BYTES = 5 * 1024 * 1024
+EXECUTOR_KIND = os.environ.get('EXECUTOR_KIND', 'thread')
+EXECUTOR_WORKERS = int(os.environ.get('EXECUTOR_WORKERS', '4'))
+EXECUTOR_MAX_PENDING = int(os.environ.get('EXECUTOR_MAX_PENDING', '64'))
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+STORAGE_PATH = os.environ.get('STORAGE_PATH', '')
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'local')
+STATE_URL = os.environ.get('STATE_URL', '')
+STATE_SYNC_INTERVAL = 5.0
+WORKERS = int(os.environ.get('WORKERS', '1'))
+WORKER_INDEX = 0
+
+PING_TIMEOUT = 2.5
+DNS_CACHE_TTL = float(os.environ.get('DNS_CACHE_TTL', '300'))
+DNS_NEGATIVE_TTL = float(os.environ.get('DNS_NEGATIVE_TTL', '30'))
+PING_CONCURRENCY = int(os.environ.get('PING_CONCURRENCY', '20'))
+HEALTH_CHECK_INTERVAL = float(os.environ.get('HEALTH_CHECK_INTERVAL', '60'))
+HEALTH_WINDOW = 30
+HEALTH_FAILURE_STREAK = 3
+HEALTH_MIN_AVAILABILITY = 0.5
+BALANCER_WINDOW = 3600.0
+BALANCER_DEFAULT_LATENCY_MS = 300
+# Telegram caps an inline keyboard at 100 buttons; pages stay well below that.
+CATALOG_PAGE_SIZE = int(os.environ.get('CATALOG_PAGE_SIZE', '20'))
+CATALOG_SEARCH_LIMIT = 20
+INLINE_RESULTS_LIMIT = 50
+INLINE_CACHE_TIME = 300
+
+QR_BOX_SIZE = 10
+QR_BORDER = 4
+QR_CACHE_SIZE = 256
+QR_CACHE_DIR = os.environ.get('QR_CACHE_DIR', '')
+
+BROADCAST_RATE = 30.0
+BROADCAST_PER_CHAT_INTERVAL = 1.0
+BROADCAST_WORKERS = 25
+# Sends queued ahead of the lowest unfinished one, so a slow chat never stalls the rest.
+BROADCAST_WINDOW = 500
+BROADCAST_MAX_ATTEMPTS = 4
+BROADCAST_MAX_BACKOFF = 4.0
+BROADCAST_PROGRESS_INTERVAL = 5.0
+# A stored broadcast whose checkpoint is older than this has no live sender.
+BROADCAST_STALE_AFTER = 60.0
+
+METRICS_LISTEN = os.environ.get('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROFILE_ENABLED = os.environ.get('PROFILE', '') == '1'
+SLOW_UPDATE_THRESHOLD = float(os.environ.get('SLOW_UPDATE_THRESHOLD', '0.5'))
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0.1'))
+PROFILE_TOP_N = 10
+
+FLOOD_RATE = float(os.environ.get('FLOOD_RATE', '1.0'))
+FLOOD_BURST = float(os.environ.get('FLOOD_BURST', '5'))
+FLOOD_DUPLICATE_WINDOW = 1.5
+FLOOD_NOTICE_INTERVAL = 10.0
+FLOOD_SWEEP_INTERVAL = 60.0
+
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+TELEGRAM_BASE_URL = os.environ.get('TELEGRAM_BASE_URL', '')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', '40'))
+# Outbound Bot API client. getUpdates gets its own single-connection pool so a
+# long poll never holds a slot that send_photo or a broadcast is waiting for.
+API_POOL_SIZE = int(os.environ.get('API_POOL_SIZE', '256'))
+API_HTTP2 = os.environ.get('API_HTTP2', '') == '1'
+API_CONNECT_TIMEOUT = float(os.environ.get('API_CONNECT_TIMEOUT', '5'))
+API_READ_TIMEOUT = float(os.environ.get('API_READ_TIMEOUT', '10'))
+API_WRITE_TIMEOUT = float(os.environ.get('API_WRITE_TIMEOUT', '10'))
+API_POOL_TIMEOUT = float(os.environ.get('API_POOL_TIMEOUT', '5'))
+CONCURRENT_UPDATES = int(os.environ.get('CONCURRENT_UPDATES', '256'))
+SUBSCRIPTION_LISTEN = os.environ.get('SUBSCRIPTION_LISTEN', '0.0.0.0')
+SUBSCRIPTION_PORT = int(os.environ.get('SUBSCRIPTION_PORT', '0'))
+SUBSCRIPTION_PATH = os.environ.get('SUBSCRIPTION_PATH', '/sub')
+SUBSCRIPTION_PUBLIC_URL = os.environ.get('SUBSCRIPTION_PUBLIC_URL', '')
+SUBSCRIPTION_MAX_AGE = 300
+SUBSCRIPTION_UPDATE_INTERVAL_HOURS = 6
+SUBSCRIPTION_PROFILE_NAME = "Azadi-Net"
+HTTP_MAX_BODY = 1024 * 1024
+HTTP_IDLE_TIMEOUT = 30.0
+
+logger = logging.getLogger(__name__)
+
+
+class BlockingExecutor:
+    """Single entry point for work that must not run on the event loop.
+
+    Blocking I/O always goes to a thread pool; CPU-bound work (``cpu=True``)
+    goes to a process pool when EXECUTOR_KIND is 'process'. At most
+    ``max_pending`` jobs are submitted at once, the rest wait their turn.
+    """
+
+    def __init__(self, kind: str, workers: int, max_pending: int):
+        self.kind = kind
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.peak_pending = 0
+        self._threads = None
+        self._processes = None
+        self._slots = None
+
+    def _pool(self, cpu: bool):
+        if cpu and self.kind == 'process':
+            if self._processes is None:
+                self._processes = ProcessPoolExecutor(max_workers=self.workers)
+            return self._processes
+        if self._threads is None:
+            self._threads = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='azadi')
+        return self._threads
+
+    async def run(self, func, *args, cpu: bool = False):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        try:
+            async with self._slots:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._pool(cpu), func, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self) -> None:
+        for pool in (self._threads, self._processes):
+            if pool is not None:
+                pool.shutdown(wait=True)
+        self._threads = None
+        self._processes = None
+
+
+EXECUTOR = BlockingExecutor(EXECUTOR_KIND, EXECUTOR_WORKERS, EXECUTOR_MAX_PENDING)
+
+
+def _format_labels(labelnames, values) -> str:
+    if not labelnames:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in zip(labelnames, values)
+    )
+    return '{' + pairs + '}'
+
+
+class CounterMetric:
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self.values[key] += amount
+
+    def total(self) -> float:
+        with self._lock:
+            return sum(self.values.values())
+
+    def render(self):
+        # inc() runs on executor threads too; a new label set mid-scrape would break iteration.
+        with self._lock:
+            items = list(self.values.items())
+        for key, value in sorted(items):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class HistogramMetric:
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=METRIC_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def quantile(self, key, q: float):
+        # Upper bound of the bucket holding the q-th observation; good enough for a dashboard.
+        with self._lock:
+            series = self.series.get(key)
+            if not series or not series['count']:
+                return None
+            total, counts = series['count'], list(series['counts'])
+        target = q * total
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def render(self):
+        # Copied under the lock: observe() runs on executor threads via _timed_call.
+        with self._lock:
+            items = [(key, dict(series, counts=list(series['counts']))) for key, series in self.series.items()]
+        for key, series in sorted(items):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series['counts']):
+                cumulative += count
+                labels = _format_labels(self.labelnames + ('le',), key + (bound,))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames + ('le',), key + ('+Inf',))
+            yield f"{self.name}_bucket{labels} {series['count']}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {series['sum']}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {series['count']}"
+
+
+class CallbackMetric:
+    """Reads its values from a function at scrape time (queue depths, counters owned elsewhere)."""
+
+    def __init__(self, name: str, help_text: str, kind: str, labelnames, func):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.func = func
+
+    def render(self):
+        for key, value in sorted(self.func().items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames=()) -> CounterMetric:
+        return self.register(CounterMetric(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames=(), buckets=METRIC_BUCKETS) -> HistogramMetric:
+        return self.register(HistogramMetric(name, help_text, labelnames, buckets))
+
+    def callback(self, name: str, help_text: str, kind: str, func, labelnames=()) -> CallbackMetric:
+        return self.register(CallbackMetric(name, help_text, kind, labelnames, func))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+HANDLER_REQUESTS = METRICS.counter('azadi_handler_requests_total', "Updates handled, by handler", ('handler',))
+HANDLER_ERRORS = METRICS.counter('azadi_handler_errors_total', "Handlers that raised, by handler", ('handler',))
+HANDLER_LATENCY = METRICS.histogram('azadi_handler_duration_seconds', "Handler wall time", ('handler',))
+API_LATENCY = METRICS.histogram('azadi_telegram_api_duration_seconds', "Bot API call latency", ('method',))
+API_ERRORS = METRICS.counter('azadi_telegram_api_errors_total', "Bot API call errors", ('method', 'error'))
+BROADCAST_MESSAGES = METRICS.counter('azadi_broadcast_messages_total', "Broadcast deliveries by outcome", ('result',))
+STORAGE_LATENCY = METRICS.histogram('azadi_storage_write_duration_seconds', "Storage write latency", ('operation',))
+LOOP_LAG = METRICS.histogram(
+    'azadi_event_loop_lag_seconds', "Extra delay of a periodic sleep on the event loop",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+PROBE_LATENCY = METRICS.histogram('azadi_probe_duration_seconds', "Server probe time by phase", ('phase',))
+METRICS.callback(
+    'azadi_executor_pending', "Jobs queued or running in the blocking executor", 'gauge',
+    lambda: {(): EXECUTOR.pending},
+)
+
+
+CURRENT_TRACE = contextvars.ContextVar('current_trace', default=None)
+
+
+def untraced_task(coro) -> asyncio.Task:
+    # Tasks copy the caller's context. Started from a traced handler, a background
+    # task would keep adding spans to a trace that was finished and logged long ago.
+    return contextvars.Context().run(asyncio.create_task, coro)
+
+
+class Trace:
+    __slots__ = ('path', 'spans')
+
+    def __init__(self, path: str):
+        self.path = path
+        self.spans = []
+
+    def breakdown(self, elapsed: float) -> str:
+        totals = Counter()
+        for name, duration in self.spans:
+            totals[name] += duration
+        parts = [f"{name} {duration * 1000:.0f}ms" for name, duration in totals.most_common()]
+        parts.append(f"other {max(0.0, elapsed - sum(totals.values())) * 1000:.0f}ms")
+        return ', '.join(parts)
+
+
+@contextlib.contextmanager
+def span(name: str):
+    trace = CURRENT_TRACE.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.spans.append((name, time.perf_counter() - start))
+
+
+class SlowPath:
+    __slots__ = ('path', 'count', 'total', 'worst', 'worst_breakdown', 'profile')
+
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.worst_breakdown = ''
+        self.profile = ''
+
+
+class SlowTraceLog:
+    """Updates that crossed the slow threshold, grouped by handler path.
+
+    Once a path has been slow, a sample of its later runs is profiled with
+    cProfile. The profiler sees the whole event loop while it is enabled, so
+    only one run is profiled at a time.
+    """
+
+    def __init__(self, threshold: float, sample_rate: float):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.paths = {}
+        self._profiling = False
+
+    def start_profile(self, path: str):
+        if self._profiling or path not in self.paths or random.random() >= self.sample_rate:
+            return None
+        self._profiling = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def finish(self, trace: Trace, elapsed: float, profiler=None) -> None:
+        if profiler is not None:
+            profiler.disable()
+            self._profiling = False
+        if elapsed < self.threshold:
+            return
+        breakdown = trace.breakdown(elapsed)
+        logger.warning("Slow update in %s: %.0f ms (%s)", trace.path, elapsed * 1000, breakdown)
+        record = self.paths.get(trace.path)
+        if record is None:
+            record = self.paths[trace.path] = SlowPath(trace.path)
+        record.count += 1
+        record.total += elapsed
+        if elapsed >= record.worst:
+            record.worst = elapsed
+            record.worst_breakdown = breakdown
+            if profiler is not None:
+                out = io.StringIO()
+                pstats.Stats(profiler, stream=out).strip_dirs().sort_stats('cumulative').print_stats(12)
+                record.profile = out.getvalue()
+
+    def top(self, n: int) -> list:
+        return sorted(self.paths.values(), key=lambda record: -record.worst)[:n]
+
+
+SLOW_TRACES = SlowTraceLog(SLOW_UPDATE_THRESHOLD, PROFILE_SAMPLE_RATE)
+
+
+def instrumented(name: str, handler):
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        trace = token = profiler = None
+        if PROFILE_ENABLED and CURRENT_TRACE.get() is None:
+            trace = Trace(name)
+            token = CURRENT_TRACE.set(trace)
+            profiler = SLOW_TRACES.start_profile(name)
+        try:
+            return await handler(*args, **kwargs)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            HANDLER_REQUESTS.inc(handler=name)
+            HANDLER_LATENCY.observe(elapsed, handler=name)
+            if trace is not None:
+                CURRENT_TRACE.reset(token)
+                SLOW_TRACES.finish(trace, elapsed, profiler)
+
+    wrapper.__name__ = getattr(handler, '__name__', name)
+    return wrapper
+
+
+def _timed_call(operation: str, func, *args):
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        STORAGE_LATENCY.observe(time.perf_counter() - start, operation=operation)
+
+
+async def storage_write(func, *args, operation: str = None):
+    operation = operation or func.__name__
+    with span(f"storage:{operation}"):
+        return await EXECUTOR.run(_timed_call, operation, func, *args)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    async def post(self, url: str, *args, **kwargs):
+        method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        try:
+            with span(f"api:{method}"):
+                return await super().post(url, *args, **kwargs)
+        except TelegramError as e:
+            API_ERRORS.inc(method=method, error=type(e).__name__)
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - start, method=method)
+
+
+async def _loop_lag_monitor(interval: float = 1.0) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - started - interval))
 
 DEFAULT_CONFIGS = {
     'us_vless_1': {'name': 'VLESS - USA 1 🇺🇸', 'config': 'vless://826f524a-cea1-4e44-9b49-3381d13b7593@us1.example.com:443?security=tls'},
@@ -39,43 +529,302 @@ DEFAULT_CONFIGS = {
 }
 
 
-def load_json_file(file_path: str, default_value):
-    try:
-        if not os.path.exists(file_path):
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(default_value, f, ensure_ascii=False, indent=2)
-            return json.loads(json.dumps(default_value))
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception:
-        return json.loads(json.dumps(default_value))
+STORAGE = open_storage(STORAGE_BACKEND, STORAGE_PATH, USERS_FILE, CONFIGS_FILE, DEFAULT_CONFIGS)
+CONFIGS = STORAGE.load_configs()
+# Share links are parsed once per add/edit; probes, menus and feeds read the cached records.
+PARSED = ConfigIndex()
+PARSED.sync(CONFIGS)
+
+
+class UserRegistry:
+    """Resident set of user ids with debounced write-behind to storage."""
+
+    def __init__(self, storage, flush_delay: float = USERS_FLUSH_DELAY):
+        self.storage = storage
+        self.flush_delay = flush_delay
+        self._users = set()
+        self._added = set()
+        self._removed = set()
+        self._seen = {}
+        self._flush_task = None
+        self._inflight = None
+
+    def load(self) -> None:
+        self._users = self.storage.load_users()
+        self._added.clear()
+        self._removed.clear()
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self._users
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def snapshot(self) -> list:
+        return sorted(self._users)
+
+    def adopt(self, user_id: int) -> None:
+        # Registered and stored by another worker; only this worker's copy of the set was behind.
+        self._users.add(user_id)
+
+    def add(self, user_id: int) -> bool:
+        if user_id in self._users:
+            return False
+        self._users.add(user_id)
+        self._removed.discard(user_id)
+        self._added.add(user_id)
+        self._schedule_flush()
+        return True
+
+    def discard(self, user_id: int) -> bool:
+        if user_id not in self._users:
+            return False
+        self._users.discard(user_id)
+        self._added.discard(user_id)
+        self._removed.add(user_id)
+        self._schedule_flush()
+        return True
+
+    def touch(self, user_id: int, language: str = None) -> None:
+        self._seen[user_id] = (int(time.time()), language)
+        self._schedule_flush()
+
+    def replace(self, users) -> None:
+        new_users = set(int(u) for u in users)
+        self._added = (self._added | (new_users - self._users)) & new_users
+        self._removed = (self._removed | (self._users - new_users)) - new_users
+        self._users = new_users
+        self._schedule_flush()
+
+    def _take_pending(self):
+        added, removed, seen = self._added, self._removed, self._seen
+        self._added, self._removed, self._seen = set(), set(), {}
+        return added, removed, seen
+
+    def _restore(self, added, removed, seen) -> None:
+        # Changes made since the batch was taken are newer and win.
+        self._added |= added - self._removed
+        self._removed |= removed - self._added
+        self._seen = {**seen, **self._seen}
+
+    def _write(self, added, removed, seen) -> None:
+        if added:
+            self.storage.add_users(sorted(added))
+        if removed:
+            self.storage.remove_users(sorted(removed))
+        if seen:
+            self.storage.touch_users(seen)
+
+    def _schedule_flush(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        self._flush_task = untraced_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        # Keeps draining while new users arrive during a write, so one task covers a burst.
+        while self._added or self._removed or self._seen:
+            await asyncio.sleep(self.flush_delay)
+            batch = self._inflight = self._take_pending()
+            try:
+                await storage_write(self._write, *batch, operation='users')
+            except asyncio.CancelledError:
+                # flush() has already taken the batch back.
+                raise
+            except Exception:
+                logger.exception("Failed to flush users to storage")
+                self._restore(*batch)
+            finally:
+                if self._inflight is batch:
+                    self._inflight = None
+
+    def flush(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        self._flush_task = None
+        if self._inflight is not None:
+            # The cancelled task may not have submitted its batch yet (the executor
+            # bounds submissions), so write it here; the writes are idempotent.
+            self._restore(*self._inflight)
+            self._inflight = None
+        self._write(*self._take_pending())
+
+
+USERS = UserRegistry(STORAGE)
+USERS.load()
+
+
+def normalize_language(language_code) -> str:
+    # 'en-US' and 'en' land in the same bucket.
+    return language_code.split('-')[0].lower() if language_code else None
+
+
+class ActivityIndex:
+    """Last-seen day and language per user, plus a histogram over (language, day).
+
+    Segment sizes are sums over histogram cells, so the broadcast menu can
+    show them without touching storage. Each worker only sees the activity
+    it handled since its last restart, hence "estimates"; the broadcast
+    itself filters the stored rows.
+    """
+
+    def __init__(self):
+        self._users = {}
+        self.cells = Counter()
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def load(self, batches) -> None:
+        for batch in batches:
+            for user_id, registered_at, last_seen, language in batch:
+                self.record(user_id, last_seen or registered_at, language)
+
+    def record(self, user_id: int, ts, language=None) -> None:
+        old = self._users.get(user_id)
+        if not language and old is not None:
+            language = old[0]
+        cell = (sys.intern(language) if language else None, int(ts // 86400) if ts else None)
+        if cell == old:
+            return
+        if old is not None:
+            self.cells[old] -= 1
+        self.cells[cell] += 1
+        self._users[user_id] = cell
+
+    def forget(self, user_id: int) -> None:
+        cell = self._users.pop(user_id, None)
+        if cell is not None:
+            self.cells[cell] -= 1
+
+    def estimate(self, segment, now: float) -> int:
+        first_day = int(now // 86400) - segment.active_days + 1 if segment.active_days else None
+        return sum(
+            count for (language, day), count in self.cells.items()
+            if (first_day is None or (day is not None and day >= first_day))
+            and (not segment.language or language == segment.language)
+        )
 
 
-def save_json_file(file_path: str, data) -> None:
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+ACTIVITY = ActivityIndex()
+ACTIVITY.load(STORAGE.iter_users(USER_SCAN_BATCH_SIZE))
 
 
-CONFIGS = load_json_file(CONFIGS_FILE, DEFAULT_CONFIGS)
+STATE = open_state(STATE_BACKEND, STATE_URL)
+CONFIGS_VERSION = 0
 
 
-def load_users() -> list:
-    users = load_json_file(USERS_FILE, [])
-    if isinstance(users, dict):
-        users = list(users.values())
-    return users
+async def register_user(user_id: int) -> None:
+    user_id = int(user_id)
+    if USERS.add(user_id) and STATE.shared:
+        with span('state:add_user'):
+            await STATE.add_user(user_id)
+
+
+async def forget_user(user_id: int) -> None:
+    USERS.discard(user_id)
+    ACTIVITY.forget(user_id)
+    if STATE.shared:
+        await STATE.remove_user(user_id)
+
+
+async def user_count() -> int:
+    if STATE.shared:
+        return await STATE.user_count()
+    return len(USERS)
+
+
+class CounterBuffer:
+    """Counts locally and folds the increments into shared counters on each sync."""
 
+    def __init__(self):
+        self._pending = Counter()
 
-def save_users(users: list) -> None:
-    unique_users = sorted(set(int(u) for u in users))
-    save_json_file(USERS_FILE, unique_users)
+    def incr(self, name: str, amount: int = 1) -> None:
+        self._pending[name] += amount
 
+    async def flush(self) -> None:
+        pending, self._pending = self._pending, Counter()
+        for name, amount in pending.items():
+            await STATE.incr(name, amount)
+
+    async def get(self, name: str) -> int:
+        return await STATE.get_counter(name) + self._pending[name]
+
+
+COUNTERS = CounterBuffer()
+
+
+async def sync_shared_state() -> None:
+    global CONFIGS_VERSION
+    await COUNTERS.flush()
+    if not STATE.shared:
+        return
+    version = await STATE.get_counter('configs_version')
+    if version != CONFIGS_VERSION:
+        configs = await EXECUTOR.run(STORAGE.load_configs)
+        CONFIGS.clear()
+        CONFIGS.update(configs)
+        CONFIGS_VERSION = version
+        await on_configs_changed()
+    if WORKER_INDEX == 0:
+        if HEALTH.last_checked is not None:
+            await STATE.set_blob('health', HEALTH.snapshot())
+    else:
+        snapshot = await STATE.get_blob('health')
+        if snapshot:
+            HEALTH.restore(snapshot)
+
+
+async def _state_sync_loop() -> None:
+    while True:
+        await asyncio.sleep(STATE_SYNC_INTERVAL)
+        try:
+            await sync_shared_state()
+        except Exception:
+            logger.exception("Shared state sync failed")
 
-def register_user(user_id: int) -> None:
-    users = load_users()
-    if user_id not in users:
-        users.append(user_id)
-        save_users(users)
+
+async def publish_configs_change() -> None:
+    global CONFIGS_VERSION
+    if STATE.shared:
+        CONFIGS_VERSION = await STATE.incr('configs_version')
+
+
+async def on_configs_changed() -> None:
+    PARSED.sync(CONFIGS)
+    RESOLVER.prune({PARSED.get(cfg_id, cfg).host for cfg_id, cfg in CONFIGS.items()})
+    MENUS.rebuild_config_menus()
+    urls = [cfg['config'] for cfg in CONFIGS.values()]
+    await EXECUTOR.run(QR_CACHE.retain, urls)
+    await warm_qr_cache(urls)
+    if SUBSCRIPTION_PORT:
+        await EXECUTOR.run(SUBSCRIPTIONS.rebuild, dict(CONFIGS))
+
+
+async def save_config(cfg_id: str, cfg: dict) -> None:
+    CONFIGS[cfg_id] = cfg
+    await storage_write(STORAGE.put_config, cfg_id, cfg)
+    await publish_configs_change()
+    await on_configs_changed()
+
+
+async def save_configs(configs: dict) -> None:
+    CONFIGS.update(configs)
+    await storage_write(STORAGE.put_configs, configs)
+    await publish_configs_change()
+    await on_configs_changed()
+
+
+async def delete_config(cfg_id: str) -> None:
+    CONFIGS.pop(cfg_id, None)
+    await storage_write(STORAGE.delete_config, cfg_id)
+    await publish_configs_change()
+    await on_configs_changed()
 
 
 def format_uptime(seconds: float) -> str:
@@ -104,32 +853,248 @@ FAQS = [
     {"question": "آیا استفاده امن است؟", "answer": "بله، از پروتکل‌های رمزنگاری پیشرفته استفاده می‌کنیم."},
 ]
 
-SUBSCRIPTION_LINK = "https://dev1.irdevs.sbs"
+SUBSCRIPTION_LINK = SUBSCRIPTION_PUBLIC_URL or "https://dev1.irdevs.sbs"
+
+CLIENTS = {
+    "Android": ("V2RayNG", "https://github.com/2dust/v2rayNG/releases"),
+    "iOS": ("Streisand", "https://apps.apple.com/app/streisand/id6450534064"),
+    "Windows": ("v2rayN", "https://github.com/2dust/v2rayN/releases"),
+    "macOS": ("Hiddify Next", "https://github.com/hiddify/hiddify-next/releases"),
+    "Linux": ("Qv2ray", "https://github.com/Qv2ray/Qv2ray"),
+    "Router": ("Clash", "https://github.com/Dreamacro/clash"),
+}
+
+WELCOME_TEXT = (
+    "🌐 به ربات آزادی‌نت خوش آمدید!\n"
+    "لطفاً گزینه مورد نظر را انتخاب کنید:"
+)
+
+
+def back_markup(callback_data: str, label: str = "🔙 بازگشت") -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton(label, callback_data=callback_data)]])
+
+
+class CatalogEntry:
+    __slots__ = ('cfg_id', 'name', 'country', 'protocol', 'haystack')
+
+    def __init__(self, cfg_id: str, cfg: dict, parsed: ParsedConfig):
+        self.cfg_id = cfg_id
+        self.name = cfg['name']
+        self.country = parsed.country
+        self.protocol = parsed.protocol
+        self.haystack = ' '.join(filter(None, (cfg['name'], cfg_id, parsed.protocol, parsed.country))).casefold()
+
+
+def parse_catalog_target(raw: str) -> tuple:
+    # '<page>_<filter>': '0_all', '2_c-DE', '1_p-vless'
+    page, _, key = raw.partition('_')
+    return key or 'all', int(page)
+
+
+class ServerCatalog:
+    """A server list split into pages and indexed by country and protocol.
+
+    A new catalog is built whenever the config menus are rebuilt. Page and
+    filter keyboards are made on first view and reused until then, so
+    browsing never walks CONFIGS.
+    """
+
+    def __init__(self, entries: list, prefix: str, button, columns: int, back: str, top_rows=()):
+        self.entries = entries
+        self.prefix = prefix
+        self.button = button
+        self.columns = columns
+        self.back = back
+        self.top_rows = list(top_rows)
+        self.index = {'all': entries}
+        for entry in entries:
+            if entry.country:
+                self.index.setdefault(f'c-{entry.country}', []).append(entry)
+            self.index.setdefault(f'p-{entry.protocol}', []).append(entry)
+        self.home = back_markup(f'{prefix}0_all')
+        self._pages = {}
+        self._filters = None
+
+    def page_count(self, key: str) -> int:
+        return max(1, math.ceil(len(self.index.get(key, ())) / CATALOG_PAGE_SIZE))
+
+    def resolve(self, key: str, page: int) -> tuple:
+        if key not in self.index:
+            key = 'all'
+        return key, min(max(page, 0), self.page_count(key) - 1)
+
+    def label(self, key: str) -> str:
+        kind, _, value = key.partition('-')
+        if kind == 'c':
+            return f"{country_flag(value)} {value}"
+        if kind == 'p':
+            return value.upper()
+        return "همه"
+
+    def _rows(self, entries) -> list:
+        buttons = [self.button(entry) for entry in entries]
+        return [buttons[i:i + self.columns] for i in range(0, len(buttons), self.columns)]
+
+    def page(self, key: str, page: int) -> InlineKeyboardMarkup:
+        markup = self._pages.get((key, page))
+        if markup is not None:
+            return markup
+        start = page * CATALOG_PAGE_SIZE
+        keyboard = self.top_rows + self._rows(self.index[key][start:start + CATALOG_PAGE_SIZE])
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀️ قبلی", callback_data=f'{self.prefix}{page - 1}_{key}'))
+        if page + 1 < self.page_count(key):
+            nav.append(InlineKeyboardButton("بعدی ▶️", callback_data=f'{self.prefix}{page + 1}_{key}'))
+        if nav:
+            keyboard.append(nav)
+        keyboard.append([
+            InlineKeyboardButton("🗂️ فیلتر", callback_data=f'{self.prefix}filters'),
+            InlineKeyboardButton("🔎 جستجو", callback_data=f'{self.prefix}search'),
+        ])
+        keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data=self.back)])
+        markup = self._pages[(key, page)] = InlineKeyboardMarkup(keyboard)
+        return markup
+
+    def filters(self) -> InlineKeyboardMarkup:
+        if self._filters is None:
+            keyboard = []
+            for kind, columns in (('c-', 3), ('p-', 3)):
+                buttons = [
+                    InlineKeyboardButton(f"{self.label(key)} ({len(entries)})", callback_data=f'{self.prefix}0_{key}')
+                    for key, entries in sorted(self.index.items()) if key.startswith(kind)
+                ]
+                keyboard += [buttons[i:i + columns] for i in range(0, len(buttons), columns)]
+            keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data=f'{self.prefix}0_all')])
+            self._filters = InlineKeyboardMarkup(keyboard)
+        return self._filters
+
+    def search(self, text: str, limit: int) -> list:
+        terms = text.casefold().split()
+        matches = []
+        for entry in self.entries:
+            if all(term in entry.haystack for term in terms):
+                matches.append(entry)
+                if len(matches) >= limit:
+                    break
+        return matches
+
+    def results(self, entries: list) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(
+            self._rows(entries) + [[InlineKeyboardButton("🔙 بازگشت", callback_data=f'{self.prefix}0_all')]]
+        )
+
+
+class MenuRegistry:
+    """Keyboards built once and served by reference.
+
+    Markups are immutable, so the same object can be attached to any number
+    of messages. The config-dependent ones are rebuilt by
+    ``rebuild_config_menus`` whenever CONFIGS changes.
+    """
+
+    def __init__(self):
+        main_rows = [
+            [InlineKeyboardButton("📡 لینک اشتراک", callback_data='sublink')],
+            [InlineKeyboardButton("🖥️ لیست سرورها", callback_data='servers')],
+            [InlineKeyboardButton("🧰 ابزارهای کاربردی", callback_data='tools')],
+            [InlineKeyboardButton("📥 دانلود کلاینت", callback_data='clients')],
+            [InlineKeyboardButton("❓ سوالات متداول", callback_data='faq')],
+        ]
+        self.main = InlineKeyboardMarkup(main_rows)
+        self.main_admin = InlineKeyboardMarkup(
+            main_rows + [[InlineKeyboardButton("🛠️ پنل مدیریت", callback_data='admin_panel')]]
+        )
+        self.admin_panel = InlineKeyboardMarkup([
+            [InlineKeyboardButton("📊 آمار ربات", callback_data='admin_stats')],
+            [InlineKeyboardButton("🧩 لیست کانفیگ‌ها", callback_data='admin_list_configs')],
+            [InlineKeyboardButton("➕ افزودن کانفیگ", callback_data='admin_add_config')],
+            [InlineKeyboardButton("📥 ورود گروهی کانفیگ‌ها", callback_data='admin_bulk_import')],
+            [InlineKeyboardButton("➖ حذف کانفیگ", callback_data='admin_remove_config')],
+            [InlineKeyboardButton("📣 ارسال پیام همگانی", callback_data='admin_broadcast')],
+            [InlineKeyboardButton("📤 خروجی کاربران", callback_data='admin_export_users')],
+            [InlineKeyboardButton("🐢 کندترین مسیرها", callback_data='admin_slow')],
+            [InlineKeyboardButton("🔙 بازگشت", callback_data='back')],
+        ])
+        self.sublink = InlineKeyboardMarkup([
+            [InlineKeyboardButton("📋 کپی لینک", callback_data='copy_sublink')],
+            [InlineKeyboardButton("🔙 بازگشت", callback_data='back')]
+        ])
+        self.tools = InlineKeyboardMarkup([
+            [InlineKeyboardButton("📶 بررسی دسترسی سرورها", callback_data='ping_test')],
+            [InlineKeyboardButton("🛡️ راهنمای نشت DNS", callback_data='dns_test')],
+            [InlineKeyboardButton("🌍 مشاهده IP عمومی", callback_data='ip_info')],
+            [InlineKeyboardButton("🔙 بازگشت", callback_data='back')]
+        ])
+        self.clients_text = "📥 کلاینت‌های پیشنهادی:\n\n" + "".join(
+            f"• {os_name}: [{client}]({url})\n" for os_name, (client, url) in CLIENTS.items()
+        )
+        self.faq = InlineKeyboardMarkup(
+            [[InlineKeyboardButton(f"❓ {faq['question']}", callback_data=f'faq_{i}')] for i, faq in enumerate(FAQS)]
+            + [[InlineKeyboardButton("🔙 بازگشت", callback_data='back')]]
+        )
+        self.export_formats = InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton("TXT", callback_data='admin_export_txt'),
+                InlineKeyboardButton("CSV", callback_data='admin_export_csv'),
+                InlineKeyboardButton("JSONL", callback_data='admin_export_jsonl'),
+            ],
+            [
+                InlineKeyboardButton("CSV.gz", callback_data='admin_export_csv.gz'),
+                InlineKeyboardButton("JSONL.gz", callback_data='admin_export_jsonl.gz'),
+            ],
+            [InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')],
+        ])
+        self.back_to_main = back_markup('back')
+        self.back_to_tools = back_markup('tools')
+        self.back_to_faq = back_markup('faq')
+        self.back_to_admin = back_markup('admin_panel')
+        self.cancel_to_admin = back_markup('admin_panel', "لغو")
+        self.server_catalog = None
+        self.visible_servers = frozenset()
+        self.remove_catalog = None
+        self.config_detail = {}
+        # Built before any health data exists, so every server starts visible.
+        self.rebuild_config_menus(frozenset(CONFIGS))
+
+    def main_menu(self, user_id) -> InlineKeyboardMarkup:
+        return self.main_admin if user_id is not None and is_admin(user_id) else self.main
+
+    def rebuild_config_menus(self, visible: frozenset = None) -> None:
+        servers = list(CONFIGS.items())
+        entries = [CatalogEntry(cfg_id, cfg, PARSED.get(cfg_id, cfg)) for cfg_id, cfg in servers]
+        self.visible_servers = visible if visible is not None else visible_config_ids()
+        self.server_catalog = ServerCatalog(
+            [entry for entry in entries if entry.cfg_id in self.visible_servers], 'srv_',
+            lambda entry: InlineKeyboardButton(entry.name, callback_data=f'config_{entry.cfg_id}'),
+            columns=2, back='back',
+            top_rows=[[InlineKeyboardButton("⭐ بهترین سرور برای من", callback_data='best_server')]],
+        )
+        self.remove_catalog = ServerCatalog(
+            entries, 'admin_rmpage_',
+            lambda entry: InlineKeyboardButton(f"🗑️ {entry.name}", callback_data=f'admin_remove_{entry.cfg_id}'),
+            columns=1, back='admin_panel',
+        )
+
+        self.config_detail = {
+            cfg_id: InlineKeyboardMarkup([
+                [InlineKeyboardButton("📋 کپی کانفیگ", callback_data=f'copy_{cfg_id}')],
+                [InlineKeyboardButton("🔙 بازگشت", callback_data='servers')]
+            ])
+            for cfg_id, _ in servers
+        }
+
+
+MENUS = MenuRegistry()
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    global MESSAGE_COUNT
-    MESSAGE_COUNT += 1
+    COUNTERS.incr('messages')
     if update.effective_user:
-        register_user(update.effective_user.id)
-
-    keyboard = [
-        [InlineKeyboardButton("📡 لینک اشتراک", callback_data='sublink')],
-        [InlineKeyboardButton("🖥️ لیست سرورها", callback_data='servers')],
-        [InlineKeyboardButton("🧰 ابزارهای کاربردی", callback_data='tools')],
-        [InlineKeyboardButton("📥 دانلود کلاینت", callback_data='clients')],
-        [InlineKeyboardButton("❓ سوالات متداول", callback_data='faq')],
-    ]
-    if update.effective_user and is_admin(update.effective_user.id):
-        keyboard.append([InlineKeyboardButton("🛠️ پنل مدیریت", callback_data='admin_panel')])
+        await register_user(update.effective_user.id)
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    await update.message.reply_text(
-        "🌐 به ربات آزادی‌نت خوش آمدید!\n"
-        "لطفاً گزینه مورد نظر را انتخاب کنید:",
-        reply_markup=reply_markup
-    )
+    user_id = update.effective_user.id if update.effective_user else None
+    await update.message.reply_text(WELCOME_TEXT, reply_markup=MENUS.main_menu(user_id))
 
 
 async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -140,126 +1105,35 @@ async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 async def show_admin_panel_from_message(update: Update) -> None:
-    keyboard = [
-        [InlineKeyboardButton("📊 آمار ربات", callback_data='admin_stats')],
-        [InlineKeyboardButton("🧩 لیست کانفیگ‌ها", callback_data='admin_list_configs')],
-        [InlineKeyboardButton("➕ افزودن کانفیگ", callback_data='admin_add_config')],
-        [InlineKeyboardButton("➖ حذف کانفیگ", callback_data='admin_remove_config')],
-        [InlineKeyboardButton("📣 ارسال پیام همگانی", callback_data='admin_broadcast')],
-        [InlineKeyboardButton("📤 خروجی کاربران", callback_data='admin_export_users')],
-        [InlineKeyboardButton("🔙 بازگشت", callback_data='back')],
-    ]
-    await update.message.reply_text("🛠️ پنل مدیریت:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await update.message.reply_text("🛠️ پنل مدیریت:", reply_markup=MENUS.admin_panel)
 
 
 async def show_admin_panel(query, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton("📊 آمار ربات", callback_data='admin_stats')],
-        [InlineKeyboardButton("🧩 لیست کانفیگ‌ها", callback_data='admin_list_configs')],
-        [InlineKeyboardButton("➕ افزودن کانفیگ", callback_data='admin_add_config')],
-        [InlineKeyboardButton("➖ حذف کانفیگ", callback_data='admin_remove_config')],
-        [InlineKeyboardButton("📣 ارسال پیام همگانی", callback_data='admin_broadcast')],
-        [InlineKeyboardButton("📤 خروجی کاربران", callback_data='admin_export_users')],
-        [InlineKeyboardButton("🔙 بازگشت", callback_data='back')],
-    ]
-    await query.edit_message_text("🛠️ پنل مدیریت:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.edit_message_text("🛠️ پنل مدیریت:", reply_markup=MENUS.admin_panel)
 
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    global MESSAGE_COUNT
-    MESSAGE_COUNT += 1
+    COUNTERS.incr('messages')
 
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-
-    if data.startswith('config_'):
-        config_id = data.split('_', 1)[1]
-        await show_config(query, context, config_id)
-        return
-    if data.startswith('faq_'):
-        faq_id = int(data.split('_')[1])
-        await show_faq_detail(query, faq_id)
-        return
-    if data.startswith('copy_'):
-        config_id = data.split('_', 1)[1]
-        await copy_config_value(query, context, config_id)
-        return
-    if data.startswith('admin_remove_'):
-        if not is_admin(query.from_user.id):
-            await query.answer("⛔ دسترسی ندارید", show_alert=True)
-            return
-        config_id = data.split('_', 2)[2]
-        await perform_remove_config(query, config_id)
-        return
-
-    handlers_simple = {
-        'sublink': show_sublink,
-        'servers': show_servers_menu,
-        'tools': show_tools_menu,
-        'clients': show_clients,
-        'faq': show_faq_menu,
-        'back': start_from_button,
-        'copy_sublink': copy_sublink,
-        'ping_test': run_ping_test,
-        'dns_test': check_dns_leak,
-        'ip_info': get_user_ip,
-    }
-
-    handlers_need_context = {
-        'admin_panel': show_admin_panel,
-        'admin_stats': admin_stats,
-        'admin_list_configs': admin_list_configs,
-        'admin_add_config': admin_add_config,
-        'admin_remove_config': admin_remove_config,
-        'admin_broadcast': admin_broadcast,
-        'admin_export_users': admin_export_users,
-    }
-
-    if data in handlers_simple:
-        await handlers_simple[data](query)
-        return
-    if data in handlers_need_context:
-        if not is_admin(query.from_user.id):
-            await query.answer("⛔ دسترسی ندارید", show_alert=True)
-            return
-        # Pass context where handlers may need it
-        await handlers_need_context[data](query, context) if handlers_need_context[data] in [admin_stats, admin_list_configs, admin_add_config, admin_remove_config, admin_broadcast, admin_export_users, show_admin_panel] else await handlers_need_context[data](query)
+    await ROUTER.dispatch(update.callback_query, context)
 
 
 async def start_from_button(query):
-    keyboard = [
-        [InlineKeyboardButton("📡 لینک اشتراک", callback_data='sublink')],
-        [InlineKeyboardButton("🖥️ لیست سرورها", callback_data='servers')],
-        [InlineKeyboardButton("🧰 ابزارهای کاربردی", callback_data='tools')],
-        [InlineKeyboardButton("📥 دانلود کلاینت", callback_data='clients')],
-        [InlineKeyboardButton("❓ سوالات متداول", callback_data='faq')],
-    ]
-    if is_admin(query.from_user.id):
-        keyboard.append([InlineKeyboardButton("🛠️ پنل مدیریت", callback_data='admin_panel')])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    await query.edit_message_text(
-        "🌐 به ربات آزادی‌نت خوش آمدید!\n"
-        "لطفاً گزینه مورد نظر را انتخاب کنید:",
-        reply_markup=reply_markup
-    )
+    await query.edit_message_text(WELCOME_TEXT, reply_markup=MENUS.main_menu(query.from_user.id))
 
 
 async def show_sublink(query):
-    keyboard = [
-        [InlineKeyboardButton("📋 کپی لینک", callback_data='copy_sublink')],
-        [InlineKeyboardButton("🔙 بازگشت", callback_data='back')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
+    variants = ""
+    if SUBSCRIPTION_PUBLIC_URL:
+        base = SUBSCRIPTION_PUBLIC_URL.rstrip('/')
+        variants = f"Clash:\n`{base}/clash`\n\nsing-box:\n`{base}/singbox`\n\n"
     await query.edit_message_text(
         f"🔗 لینک اشتراک سرویس:\n\n"
         f"`{SUBSCRIPTION_LINK}`\n\n"
+        f"{variants}"
         "این لینک را در کلاینت VPN خود وارد کنید تا همه سرورها اضافه شوند.",
         parse_mode='Markdown',
-        reply_markup=reply_markup
+        reply_markup=MENUS.sublink
     )
 
 
@@ -267,71 +1141,235 @@ async def copy_sublink(query):
     await query.answer('✅ لینک اشتراک در حافظه موقت کپی شد!', show_alert=True)
 
 
-async def show_servers_menu(query):
-    keyboard = []
-    servers = list(CONFIGS.keys())
-
-    for i in range(0, len(servers), 2):
-        row = []
-        if i < len(servers):
-            row.append(InlineKeyboardButton(
-                CONFIGS[servers[i]]['name'],
-                callback_data=f'config_{servers[i]}'
-            ))
-        if i+1 < len(servers):
-            row.append(InlineKeyboardButton(
-                CONFIGS[servers[i+1]]['name'],
-                callback_data=f'config_{servers[i+1]}'
-            ))
-        if row:
-            keyboard.append(row)
-
-    keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data='back')])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
+async def show_catalog_page(query, catalog: ServerCatalog, title: str, key: str, page: int):
+    key, page = catalog.resolve(key, page)
+    if key != 'all' or catalog.page_count(key) > 1:
+        title += f" — {catalog.label(key)} (صفحه {page + 1} از {catalog.page_count(key)})"
+    await query.edit_message_text(f"{title}:", reply_markup=catalog.page(key, page))
+
+
+async def start_catalog_search(query, catalog_name: str, catalog: ServerCatalog):
+    await STATE.set_conversation(query.from_user.id, {'awaiting': 'server_search', 'catalog': catalog_name})
     await query.edit_message_text(
-        "🖥️ سرورهای موجود:",
-        reply_markup=reply_markup
+        "🔎 بخشی از نام سرور، کد کشور (مثلاً DE) یا پروتکل (مثلاً vless) را بفرستید:",
+        reply_markup=catalog.home
     )
 
 
-async def show_config(query, context: ContextTypes.DEFAULT_TYPE, config_id):
-    config = CONFIGS.get(config_id)
-    if not config:
-        await query.answer("⚠️ سرور یافت نشد!")
+async def show_servers_menu(query):
+    await show_servers_page(query, ('all', 0))
+
+
+async def show_servers_page(query, target: tuple):
+    await show_catalog_page(query, MENUS.server_catalog, "🖥️ سرورهای موجود", *target)
+
+
+async def show_server_filters(query):
+    await query.edit_message_text("🗂️ فیلتر بر اساس کشور یا پروتکل:", reply_markup=MENUS.server_catalog.filters())
+
+
+async def start_server_search(query):
+    await start_catalog_search(query, 'servers', MENUS.server_catalog)
+
+
+async def reply_catalog_search(update: Update, catalog: ServerCatalog) -> None:
+    matches = catalog.search(update.message.text, CATALOG_SEARCH_LIMIT)
+    if not matches:
+        await update.message.reply_text("🔎 سروری با این مشخصات پیدا نشد.", reply_markup=catalog.home)
         return
+    await update.message.reply_text(f"🔎 نتایج جستجو ({len(matches)}):", reply_markup=catalog.results(matches))
 
+
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    inline_query = update.inline_query
+    results = []
+    for entry in MENUS.server_catalog.search(inline_query.query, INLINE_RESULTS_LIMIT):
+        config = CONFIGS.get(entry.cfg_id)
+        if config is None:
+            continue
+        country = f"{country_flag(entry.country)} {entry.country}" if entry.country else None
+        results.append(InlineQueryResultArticle(
+            id=entry.cfg_id,
+            title=entry.name,
+            description=" · ".join(filter(None, (entry.protocol.upper(), country))),
+            input_message_content=InputTextMessageContent(f"`{config['config']}`", parse_mode='Markdown'),
+        ))
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME)
+
+
+def render_qr_png(data: str, box_size: int, border: int) -> bytes:
     qr = qrcode.QRCode(
         version=1,
         error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
+        box_size=box_size,
+        border=border,
     )
-    qr.add_data(config['config'])
+    qr.add_data(data)
     qr.make(fit=True)
     img = qr.make_image(fill_color="black", back_color="white")
 
     bio = BytesIO()
-    bio.name = 'qrcode.png'
     img.save(bio, 'PNG')
-    bio.seek(0)
+    return bio.getvalue()
 
-    keyboard = [
-        [InlineKeyboardButton("📋 کپی کانفیگ", callback_data=f'copy_{config_id}')],
-        [InlineKeyboardButton("🔙 بازگشت", callback_data='servers')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await context.bot.send_photo(
+class QRCache:
+    """LRU of rendered QR PNGs keyed by a hash of the config URL and render params."""
+
+    def __init__(self, max_entries: int, cache_dir: str = ''):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(data: str) -> str:
+        return hashlib.sha256(f"L:{QR_BOX_SIZE}:{QR_BORDER}:{data}".encode('utf-8')).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def _load_from_disk(self, key: str):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _store_on_disk(self, key: str, png: bytes) -> None:
+        if not self.cache_dir:
+            return
+        tmp_path = self._disk_path(key) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(png)
+        os.replace(tmp_path, self._disk_path(key))
+
+    def lookup(self, data: str):
+        key = self.key(data)
+        with self._lock:
+            png = self._entries.get(key)
+            if png is not None:
+                self._entries.move_to_end(key)
+            return png
+
+    def put(self, data: str, png: bytes) -> None:
+        key = self.key(data)
+        with self._lock:
+            self._entries[key] = png
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def load_from_disk(self, data: str):
+        png = self._load_from_disk(self.key(data))
+        if png is not None:
+            self.put(data, png)
+        return png
+
+    def save_to_disk(self, data: str, png: bytes) -> None:
+        self._store_on_disk(self.key(data), png)
+
+    def retain(self, urls) -> None:
+        keep = set(self.key(url) for url in urls)
+        with self._lock:
+            for key in [k for k in self._entries if k not in keep]:
+                del self._entries[key]
+        if self.cache_dir:
+            for filename in os.listdir(self.cache_dir):
+                if filename.endswith('.png') and filename[:-4] not in keep:
+                    try:
+                        os.remove(os.path.join(self.cache_dir, filename))
+                    except OSError:
+                        pass
+
+
+QR_CACHE = QRCache(QR_CACHE_SIZE, QR_CACHE_DIR)
+# Telegram file_id of each uploaded QR, keyed by QR_CACHE.key(url). Kept apart from
+# the config rows so recording one can never resurrect a config another worker deleted.
+QR_FILE_IDS = {}
+
+
+async def get_qr_png(data: str) -> bytes:
+    png = QR_CACHE.lookup(data)
+    if png is None:
+        with span('qr:render'):
+            png = await EXECUTOR.run(render_qr_png, data, QR_BOX_SIZE, QR_BORDER, cpu=True)
+        QR_CACHE.put(data, png)
+        await EXECUTOR.run(QR_CACHE.save_to_disk, data, png)
+    return png
+
+
+async def warm_qr_cache(urls) -> None:
+    missing = [url for url in urls if QR_CACHE.lookup(url) is None]
+    if QR_CACHE.cache_dir:
+        loaded = await asyncio.gather(*(EXECUTOR.run(QR_CACHE.load_from_disk, url) for url in missing))
+        missing = [url for url, png in zip(missing, loaded) if png is None]
+    await asyncio.gather(*(get_qr_png(url) for url in missing))
+
+
+async def show_config(query, context: ContextTypes.DEFAULT_TYPE, config_id, recommended: bool = False):
+    config = CONFIGS.get(config_id)
+    if not config:
+        await query.answer("⚠️ سرور یافت نشد!")
+        return
+    BALANCER.record(config_id)
+
+    photo_kwargs = dict(
         chat_id=query.message.chat.id,
-        photo=bio,
-        caption=f"⚙️ {config['name']}\n\n"
+        caption=("⭐ پیشنهاد ما بر اساس سرعت و شلوغی سرورها:\n" if recommended else "")
+                + f"⚙️ {config['name']}\n\n"
                 "برای اتصال سریع، QR کد را با کلاینت خود اسکن کنید.",
-        reply_markup=reply_markup
+        reply_markup=MENUS.config_detail.get(config_id),
     )
+
+    qr_key = QR_CACHE.key(config['config'])
+    file_id = await qr_file_id(qr_key)
+    if file_id is None and config.get('qr_key') == qr_key:
+        # Configs saved before file_ids moved to meta still carry one.
+        file_id = config.get('qr_file_id')
+    sent = False
+    if file_id:
+        try:
+            await context.bot.send_photo(photo=file_id, **photo_kwargs)
+            sent = True
+        except BadRequest:
+            logger.warning("Cached QR file_id for %s was rejected, re-uploading", config_id)
+    if not sent:
+        bio = BytesIO(await get_qr_png(config['config']))
+        bio.name = 'qrcode.png'
+        message = await context.bot.send_photo(photo=bio, **photo_kwargs)
+        if message.photo:
+            await remember_qr_file_id(qr_key, message.photo[-1].file_id)
     await query.delete_message()
 
 
+async def show_best_server(query, context: ContextTypes.DEFAULT_TYPE):
+    config_id = BALANCER.pick()
+    if config_id is None:
+        await query.answer("⚠️ در حال حاضر سروری در دسترس نیست", show_alert=True)
+        return
+    await show_config(query, context, config_id, recommended=True)
+
+
+async def qr_file_id(qr_key: str):
+    file_id = QR_FILE_IDS.get(qr_key)
+    if file_id is None:
+        # Another worker or an earlier run may have uploaded it already.
+        file_id = await EXECUTOR.run(STORAGE.get_meta, f'qr_file:{qr_key}')
+        if file_id:
+            QR_FILE_IDS[qr_key] = file_id
+    return file_id
+
+
+async def remember_qr_file_id(qr_key: str, file_id: str) -> None:
+    QR_FILE_IDS[qr_key] = file_id
+    await storage_write(STORAGE.set_meta, f'qr_file:{qr_key}', file_id)
+
+
 async def copy_config_value(query, context: ContextTypes.DEFAULT_TYPE, config_id: str):
     config = CONFIGS.get(config_id)
     if not config:
@@ -346,77 +1384,285 @@ async def copy_config_value(query, context: ContextTypes.DEFAULT_TYPE, config_id
 
 
 async def show_tools_menu(query):
-    keyboard = [
-        [InlineKeyboardButton("📶 بررسی دسترسی سرورها", callback_data='ping_test')],
-        [InlineKeyboardButton("🛡️ راهنمای نشت DNS", callback_data='dns_test')],
-        [InlineKeyboardButton("🌍 مشاهده IP عمومی", callback_data='ip_info')],
-        [InlineKeyboardButton("🔙 بازگشت", callback_data='back')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await query.edit_message_text(
         "🧰 ابزارهای کاربردی:",
-        reply_markup=reply_markup
+        reply_markup=MENUS.tools
     )
 
 
-def parse_host_port_from_config_url(config_url: str):
+RESOLVER = DnsResolver(DNS_CACHE_TTL, DNS_NEGATIVE_TTL, timeout=PING_TIMEOUT)
+METRICS.callback(
+    'azadi_dns_lookups_total', "Probe hostname lookups by cache outcome", 'counter',
+    lambda: {(result,): count for result, count in RESOLVER.lookups.items()}, ('result',),
+)
+
+
+async def probe_server(host: str, port: int, timeout: float = None):
+    # Resolution is timed and cached on its own so DNS never counts as server latency.
+    # RESOLVER applies its own timeout to the shared lookup; no outer wait_for here.
+    timeout = timeout or PING_TIMEOUT
+    start = time.perf_counter()
     try:
-        parsed = urlparse(config_url)
-        host = parsed.hostname
-        port = parsed.port
-        return host, port
-    except Exception:
-        return None, None
+        with span('probe:resolve'):
+            addresses = await RESOLVER.resolve(host)
+    except (OSError, ValueError, asyncio.TimeoutError):
+        # ValueError covers UnicodeError for malformed names such as 'us1..example.com'.
+        return None
+    PROBE_LATENCY.observe(time.perf_counter() - start, phase='resolve')
+    start = time.perf_counter()
+    writer = None
+    for address in addresses:
+        remaining = timeout - (time.perf_counter() - start)
+        if remaining <= 0:
+            break
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(address, port), remaining)
+            break
+        except (OSError, ValueError, asyncio.TimeoutError):
+            continue
+    if writer is None:
+        return None
+    elapsed = time.perf_counter() - start
+    PROBE_LATENCY.observe(elapsed, phase='connect')
+    latency_ms = int(elapsed * 1000)
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return latency_ms
 
 
-async def run_ping_test(query):
-    server_entries = []
-    for cfg_id, cfg in CONFIGS.items():
-        host, port = parse_host_port_from_config_url(cfg['config'])
+async def probe_servers(targets, concurrency: int = None) -> list:
+    semaphore = asyncio.Semaphore(concurrency or PING_CONCURRENCY)
+
+    async def bounded(host, port):
         if not host:
-            server_entries.append((cfg['name'], None, None))
-        else:
-            server_entries.append((cfg['name'], host, port if port else 443))
+            return None
+        async with semaphore:
+            return await probe_server(host, port)
+
+    with span('probe'):
+        return await asyncio.gather(*(bounded(host, port) for host, port in targets))
+
+
+def config_probe_target(cfg_id: str, cfg: dict):
+    parsed = PARSED.get(cfg_id, cfg)
+    return parsed.host, parsed.port
+
+
+class ServerHealth:
+    def __init__(self, window: int):
+        self.samples = deque(maxlen=window)
+
+    def record(self, latency_ms) -> None:
+        self.samples.append(latency_ms)
+
+    @property
+    def last(self):
+        return self.samples[-1] if self.samples else None
+
+    def availability(self) -> float:
+        if not self.samples:
+            return 0.0
+        return sum(1 for s in self.samples if s is not None) / len(self.samples)
+
+    def percentile(self, pct: float):
+        ok = sorted(s for s in self.samples if s is not None)
+        if not ok:
+            return None
+        rank = max(0, math.ceil(pct / 100 * len(ok)) - 1)
+        return ok[rank]
+
+    def is_healthy(self) -> bool:
+        # A server needs a few rounds of evidence before it is hidden.
+        if len(self.samples) < HEALTH_FAILURE_STREAK:
+            return True
+        recent = list(self.samples)[-HEALTH_FAILURE_STREAK:]
+        if all(s is None for s in recent):
+            return False
+        return self.availability() >= HEALTH_MIN_AVAILABILITY
+
+
+class HealthMonitor:
+    """Probes every config on a fixed interval and keeps a rolling window per server."""
+
+    def __init__(self, interval: float = HEALTH_CHECK_INTERVAL, window: int = HEALTH_WINDOW):
+        self.interval = interval
+        self.window = window
+        self.servers = {}
+        self.last_checked = None
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    async def check_now(self) -> None:
+        async with self._lock:
+            await self._probe_round()
+        refresh_server_visibility()
+
+    async def ensure_checked(self) -> None:
+        if self.last_checked is not None:
+            return
+        async with self._lock:
+            # Callers that queued behind the first round reuse its results.
+            if self.last_checked is not None:
+                return
+            await self._probe_round()
+        refresh_server_visibility()
+
+    async def _probe_round(self) -> None:
+        targets = {cfg_id: config_probe_target(cfg_id, cfg) for cfg_id, cfg in CONFIGS.items()}
+        latencies = await probe_servers(list(targets.values()))
+        for (cfg_id, (host, _)), latency_ms in zip(targets.items(), latencies):
+            if host:
+                self.servers.setdefault(cfg_id, ServerHealth(self.window)).record(latency_ms)
+        for cfg_id in list(self.servers):
+            if cfg_id not in CONFIGS:
+                del self.servers[cfg_id]
+        self.last_checked = time.time()
+
+    def get(self, cfg_id: str):
+        return self.servers.get(cfg_id)
+
+    def snapshot(self) -> dict:
+        return {
+            'last_checked': self.last_checked,
+            'servers': {cfg_id: list(health.samples) for cfg_id, health in self.servers.items()},
+        }
+
+    def restore(self, snapshot: dict) -> None:
+        servers = {}
+        for cfg_id, samples in snapshot['servers'].items():
+            health = ServerHealth(self.window)
+            health.samples.extend(samples)
+            servers[cfg_id] = health
+        self.servers = servers
+        self.last_checked = snapshot['last_checked']
+        refresh_server_visibility()
+
+    def is_healthy(self, cfg_id: str) -> bool:
+        health = self.servers.get(cfg_id)
+        return health is None or health.is_healthy()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.check_now()
+            except Exception:
+                logger.exception("Health check round failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = untraced_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+HEALTH = HealthMonitor()
+
+
+def visible_config_ids() -> frozenset:
+    healthy = frozenset(cfg_id for cfg_id in CONFIGS if HEALTH.is_healthy(cfg_id))
+    # An empty menu helps nobody; if everything looks down, the probes are the likelier culprit.
+    return healthy or frozenset(CONFIGS)
+
+
+def refresh_server_visibility() -> None:
+    visible = visible_config_ids()
+    if visible != MENUS.visible_servers:
+        MENUS.rebuild_config_menus(visible)
+
+
+class ServerBalancer:
+    """Latency-weighted least-loaded choice among the visible servers.
+
+    Load is how many users were handed a server in the last ``window``
+    seconds (per worker). Cost is (load + 1) x p50 latency / availability,
+    so a server twice as fast takes about twice the users before a slower
+    one is preferred.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self.load = Counter()
+        self._assignments = deque()
+
+    def _expire(self, now: float) -> None:
+        while self._assignments and self._assignments[0][0] < now - self.window:
+            _, cfg_id = self._assignments.popleft()
+            self.load[cfg_id] -= 1
+            if self.load[cfg_id] <= 0:
+                del self.load[cfg_id]
+
+    def record(self, cfg_id: str) -> None:
+        now = time.monotonic()
+        self._expire(now)
+        self._assignments.append((now, cfg_id))
+        self.load[cfg_id] += 1
+
+    def cost(self, cfg_id: str) -> float:
+        health = HEALTH.get(cfg_id)
+        latency = health.percentile(50) if health is not None else None
+        availability = health.availability() if health is not None and health.samples else 1.0
+        return (self.load[cfg_id] + 1) * (latency or BALANCER_DEFAULT_LATENCY_MS) / max(availability, 0.1)
 
-    results_lines = ["⏳ در حال بررسی دسترسی سرورها..."]
-    await query.edit_message_text("\n".join(results_lines))
+    def rank(self, cfg_ids) -> list:
+        self._expire(time.monotonic())
+        return sorted(cfg_ids, key=lambda cfg_id: (self.cost(cfg_id), random.random()))
+
+    def pick(self):
+        ranked = self.rank(MENUS.visible_servers & CONFIGS.keys())
+        return ranked[0] if ranked else None
+
+
+BALANCER = ServerBalancer(BALANCER_WINDOW)
+
+
+async def run_ping_test(query):
+    if HEALTH.last_checked is None:
+        await query.edit_message_text("⏳ در حال بررسی دسترسی سرورها...")
+        await HEALTH.ensure_checked()
 
     results_lines = []
-    for name, host, port in server_entries:
-        if not host:
+    for cfg_id, cfg in CONFIGS.items():
+        name = cfg['name']
+        health = HEALTH.get(cfg_id)
+        if config_probe_target(cfg_id, cfg)[0] is None:
             results_lines.append(f"⚪ {name}: قالب ناشناخته")
             continue
-        start = time.perf_counter()
-        status_emoji = ""
-        text = ""
-        try:
-            with socket.create_connection((host, port), timeout=2.5):
-                latency_ms = int((time.perf_counter() - start) * 1000)
-                if latency_ms < 120:
-                    status_emoji = "🟢"
-                elif latency_ms < 250:
-                    status_emoji = "🟡"
-                else:
-                    status_emoji = "🟠"
-                text = f"{status_emoji} {name}: {latency_ms} ms"
-        except Exception:
-            text = f"🔴 {name}: ناممکن"
-        results_lines.append(text)
+        if health is None:
+            results_lines.append(f"⏳ {name}: در انتظار بررسی")
+            continue
+        latency_ms = health.last
+        if latency_ms is None:
+            results_lines.append(f"🔴 {name}: ناممکن")
+            continue
+        if latency_ms < 120:
+            status_emoji = "🟢"
+        elif latency_ms < 250:
+            status_emoji = "🟡"
+        else:
+            status_emoji = "🟠"
+        results_lines.append(f"{status_emoji} {name}: {latency_ms} ms")
 
-    keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data='tools')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    checked_ago = int(time.time() - HEALTH.last_checked)
+    reply_markup = MENUS.back_to_tools
 
     await query.edit_message_text(
         "📶 نتایج بررسی:\n\n" + "\n".join(results_lines) +
-        "\n\n🟢 خوب 🟡 متوسط 🟠 کند 🔴 ناممکن",
+        "\n\n🟢 خوب 🟡 متوسط 🟠 کند 🔴 ناممکن" +
+        f"\n🕒 آخرین بررسی: {checked_ago} ثانیه پیش",
         reply_markup=reply_markup
     )
 
 
 async def check_dns_leak(query):
-    keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data='tools')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = MENUS.back_to_tools
 
     await query.edit_message_text(
         "🛡️ برای بررسی نشت DNS از مرورگر خود استفاده کنید:\n\n"
@@ -428,8 +1674,7 @@ async def check_dns_leak(query):
 
 
 async def get_user_ip(query):
-    keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data='tools')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = MENUS.back_to_tools
 
     await query.edit_message_text(
         "🌍 ربات به IP شما دسترسی مستقیم ندارد. برای مشاهده IP عمومی خود به لینک‌های زیر بروید:\n\n"
@@ -440,44 +1685,18 @@ async def get_user_ip(query):
 
 
 async def show_clients(query):
-    clients = {
-        "Android": ("V2RayNG", "https://github.com/2dust/v2rayNG/releases"),
-        "iOS": ("Streisand", "https://apps.apple.com/app/streisand/id6450534064"),
-        "Windows": ("v2rayN", "https://github.com/2dust/v2rayN/releases"),
-        "macOS": ("Hiddify Next", "https://github.com/hiddify/hiddify-next/releases"),
-        "Linux": ("Qv2ray", "https://github.com/Qv2ray/Qv2ray"),
-        "Router": ("Clash", "https://github.com/Dreamacro/clash"),
-    }
-
-    message = "📥 کلاینت‌های پیشنهادی:\n\n"
-    for os_name, (client, url) in clients.items():
-        message += f"• {os_name}: [{client}]({url})\n"
-
-    keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data='back')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await query.edit_message_text(
-        message,
+        MENUS.clients_text,
         parse_mode='Markdown',
         disable_web_page_preview=True,
-        reply_markup=reply_markup
+        reply_markup=MENUS.back_to_main
     )
 
 
 async def show_faq_menu(query):
-    keyboard = []
-    for i, faq in enumerate(FAQS):
-        keyboard.append([InlineKeyboardButton(
-            f"❓ {faq['question']}",
-            callback_data=f'faq_{i}'
-        )])
-
-    keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data='back')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await query.edit_message_text(
         "❓ سوالات متداول:",
-        reply_markup=reply_markup
+        reply_markup=MENUS.faq
     )
 
 
@@ -487,8 +1706,7 @@ async def show_faq_detail(query, faq_id):
         return
 
     faq = FAQS[faq_id]
-    keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data='faq')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = MENUS.back_to_faq
 
     await query.edit_message_text(
         f"❓ {faq['question']}\n\n"
@@ -498,18 +1716,79 @@ async def show_faq_detail(query, faq_id):
 
 
 async def admin_stats(query, context: ContextTypes.DEFAULT_TYPE):
-    users = load_users()
     uptime = format_uptime(time.time() - START_TIME)
     message = (
         "📊 آمار ربات:\n\n"
-        f"• کاربران: {len(users)}\n"
+        f"• کاربران: {await user_count()}\n"
         f"• تعداد کانفیگ‌ها: {len(CONFIGS)}\n"
-        f"• پیام‌های پردازش‌شده: {MESSAGE_COUNT}\n"
-        f"• زمان روشن بودن: {uptime}"
+        f"• پیام‌های پردازش‌شده: {await COUNTERS.get('messages')}\n"
+        f"• زمان روشن بودن: {uptime}\n"
+        f"• صف پردازش: {EXECUTOR.pending} (بیشینه {EXECUTOR.peak_pending})"
     )
-    await query.edit_message_text(message, reply_markup=InlineKeyboardMarkup([
-        [InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')]
-    ]))
+    if FLOOD.throttled:
+        message += (
+            f"\n• درخواست‌های محدودشده: {FLOOD.throttled['rate']}"
+            f" (تکراری: {FLOOD.throttled['duplicate']})"
+        )
+    top_routes = ROUTER.hits.most_common(5)
+    if top_routes:
+        message += "\n\n🔀 پرکاربردترین دکمه‌ها:\n" + "\n".join(f"• {name}: {count}" for name, count in top_routes)
+    message += "\n\n" + metrics_summary()
+    health_lines = []
+    for cfg_id, cfg in CONFIGS.items():
+        health = HEALTH.get(cfg_id)
+        if health is None:
+            continue
+        p50 = health.percentile(50)
+        p95 = health.percentile(95)
+        latency = f"p50 {p50} / p95 {p95} ms" if p50 is not None else "بدون پاسخ"
+        health_lines.append(f"• {cfg['name']}: {latency} — {health.availability() * 100:.0f}%")
+    if health_lines:
+        message += "\n\n📶 سلامت سرورها:\n" + "\n".join(health_lines)
+    await query.edit_message_text(message[:4096], reply_markup=MENUS.back_to_admin)
+
+
+def metrics_summary() -> str:
+    lines = ["⏱️ کارایی:"]
+    busiest = sorted(HANDLER_LATENCY.series.items(), key=lambda item: -item[1]['count'])[:5]
+    for key, series in busiest:
+        avg_ms = series['sum'] / series['count'] * 1000
+        p95 = HANDLER_LATENCY.quantile(key, 0.95)
+        lines.append(f"• {key[0]}: {series['count']} بار، میانگین {avg_ms:.0f} ms، p95 ≤ {p95 * 1000:.0f} ms")
+    api_calls = sum(series['count'] for series in API_LATENCY.series.values())
+    retry_after = sum(v for (method, error), v in API_ERRORS.values.items() if error == 'RetryAfter')
+    lines.append(f"• فراخوانی API: {api_calls} (خطا: {API_ERRORS.total():.0f}، RetryAfter: {retry_after:.0f})")
+    resolve_p95 = PROBE_LATENCY.quantile(('resolve',), 0.95)
+    connect_p95 = PROBE_LATENCY.quantile(('connect',), 0.95)
+    if connect_p95 is not None:
+        lines.append(
+            f"• بررسی سرورها: DNS p95 ≤ {(resolve_p95 or 0) * 1000:.0f} ms، اتصال p95 ≤ {connect_p95 * 1000:.0f} ms "
+            f"(کش DNS: {RESOLVER.lookups['hit']} موفق، {RESOLVER.lookups['miss']} پرس‌وجو، {RESOLVER.backend})"
+        )
+    lag = LOOP_LAG.quantile((), 0.99)
+    if lag is not None:
+        lines.append(f"• تأخیر حلقه رویداد p99 ≤ {lag * 1000:.0f} ms")
+    return "\n".join(lines)
+
+
+async def admin_slow_paths(query, context: ContextTypes.DEFAULT_TYPE):
+    if not PROFILE_ENABLED:
+        text = "پروفایل‌گیری خاموش است. برای فعال‌سازی ربات را با PROFILE=1 اجرا کنید."
+    elif not SLOW_TRACES.paths:
+        text = f"هیچ درخواستی کندتر از {SLOW_UPDATE_THRESHOLD * 1000:.0f} ms ثبت نشده است."
+    else:
+        records = SLOW_TRACES.top(PROFILE_TOP_N)
+        lines = [f"🐢 کندترین مسیرها (آستانه {SLOW_UPDATE_THRESHOLD * 1000:.0f} ms):\n"]
+        for record in records:
+            lines.append(
+                f"• {record.path}: {record.count} بار، بدترین {record.worst * 1000:.0f} ms، "
+                f"میانگین {record.total / record.count * 1000:.0f} ms\n  {record.worst_breakdown}"
+            )
+        profiled = next((record for record in records if record.profile), None)
+        if profiled is not None:
+            lines.append(f"\n🔬 پروفایل {profiled.path}:\n{profiled.profile}")
+        text = "\n".join(lines)
+    await query.edit_message_text(text[:4096], reply_markup=MENUS.back_to_admin)
 
 
 async def admin_list_configs(query, context: ContextTypes.DEFAULT_TYPE):
@@ -520,17 +1799,23 @@ async def admin_list_configs(query, context: ContextTypes.DEFAULT_TYPE):
         for cfg_id, cfg in CONFIGS.items():
             lines.append(f"• {cfg['name']} ({cfg_id})")
         text = "\n".join(lines)
-    await query.edit_message_text("🧩 لیست کانفیگ‌ها:\n\n" + text, reply_markup=InlineKeyboardMarkup([
-        [InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')]
-    ]))
+    await query.edit_message_text("🧩 لیست کانفیگ‌ها:\n\n" + text, reply_markup=MENUS.back_to_admin)
 
 
 async def admin_add_config(query, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data['awaiting'] = 'add_config_name'
-    context.user_data['new_config'] = {}
+    await STATE.set_conversation(query.from_user.id, {'awaiting': 'add_config_name', 'new_config': {}})
     await query.edit_message_text(
         "➕ نام نمایشی کانفیگ را ارسال کنید (مثلاً: VLESS - USA 3 🇺🇸)",
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("لغو", callback_data='admin_panel')]])
+        reply_markup=MENUS.cancel_to_admin
+    )
+
+
+async def admin_bulk_import(query, context: ContextTypes.DEFAULT_TYPE):
+    await STATE.set_conversation(query.from_user.id, {'awaiting': 'bulk_import'})
+    await query.edit_message_text(
+        "📥 لیست لینک‌های کانفیگ (هر خط یک لینک)، محتوای base64 اشتراک یا یک فایل متنی ارسال کنید.\n"
+        "نام هر کانفیگ از بخش # انتهای لینک برداشته می‌شود و موارد تکراری نادیده گرفته می‌شوند.",
+        reply_markup=MENUS.cancel_to_admin
     )
 
 
@@ -538,68 +1823,561 @@ async def admin_remove_config(query, context: ContextTypes.DEFAULT_TYPE):
     if not CONFIGS:
         await query.edit_message_text(
             "هیچ کانفیگی برای حذف وجود ندارد.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')]])
+            reply_markup=MENUS.back_to_admin
         )
         return
-    keyboard = []
-    for cfg_id, cfg in CONFIGS.items():
-        keyboard.append([InlineKeyboardButton(f"🗑️ {cfg['name']}", callback_data=f"admin_remove_{cfg_id}")])
-    keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')])
-    await query.edit_message_text("یکی را برای حذف انتخاب کنید:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await admin_remove_page(query, context, ('all', 0))
+
+
+async def admin_remove_page(query, context: ContextTypes.DEFAULT_TYPE, target: tuple):
+    await show_catalog_page(query, MENUS.remove_catalog, "یکی را برای حذف انتخاب کنید", *target)
+
+
+async def admin_remove_filters(query, context: ContextTypes.DEFAULT_TYPE):
+    await query.edit_message_text("🗂️ فیلتر بر اساس کشور یا پروتکل:", reply_markup=MENUS.remove_catalog.filters())
+
+
+async def admin_remove_search(query, context: ContextTypes.DEFAULT_TYPE):
+    await start_catalog_search(query, 'remove', MENUS.remove_catalog)
 
 
 async def perform_remove_config(query, config_id: str):
     if config_id in CONFIGS:
         removed_name = CONFIGS[config_id]['name']
-        del CONFIGS[config_id]
-        save_json_file(CONFIGS_FILE, CONFIGS)
+        await delete_config(config_id)
         await query.edit_message_text(
             f"✅ حذف شد: {removed_name}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')]])
+            reply_markup=MENUS.back_to_admin
         )
     else:
         await query.answer("⚠️ یافت نشد")
 
 
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def is_full(self, now: float) -> bool:
+        return self._tokens + (now - self._updated) * self.rate >= self.capacity
+
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        if now < self._blocked_until:
+            return False
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class RateLimiter:
+    """Global token bucket plus a minimum interval between messages to the same chat."""
+
+    def __init__(self, rate: float, per_chat_interval: float):
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self._next_allowed = {}
+
+    async def wait(self, chat_id: int) -> None:
+        now = time.monotonic()
+        next_allowed = self._next_allowed.get(chat_id, 0.0)
+        self._next_allowed[chat_id] = max(now, next_allowed) + self.per_chat_interval
+        if next_allowed > now:
+            await asyncio.sleep(next_allowed - now)
+        await self.bucket.acquire()
+
+    def forget(self, chat_id: int) -> None:
+        self._next_allowed.pop(chat_id, None)
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    delay = error.retry_after
+    if isinstance(delay, datetime.timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+
+ACTIVE_BROADCAST = None
+
+
+class Segment:
+    __slots__ = ('key', 'title', 'active_days', 'language')
+
+    def __init__(self, key: str, title: str, active_days: int = None, language: str = None):
+        self.key = key
+        self.title = title
+        self.active_days = active_days
+        self.language = language
+
+    def matches(self, registered_at, last_seen, language, now: float) -> bool:
+        if self.active_days:
+            seen = last_seen or registered_at
+            if not seen or seen < now - self.active_days * 86400:
+                return False
+        return not self.language or language == self.language
+
+
+BROADCAST_SEGMENTS = {segment.key: segment for segment in (
+    Segment('all', "همه کاربران"),
+    Segment('active7', "فعال در ۷ روز اخیر", active_days=7),
+    Segment('active30', "فعال در ۳۰ روز اخیر", active_days=30),
+    Segment('active90', "فعال در ۹۰ روز اخیر", active_days=90),
+    Segment('fa30', "فارسی‌زبان، فعال در ۳۰ روز اخیر", active_days=30, language='fa'),
+    Segment('en', "انگلیسی‌زبان", language='en'),
+)}
+
+
+def segment_users(segment: Segment, now: float) -> list:
+    users = []
+    for batch in STORAGE.iter_users(USER_SCAN_BATCH_SIZE):
+        users.extend(row[0] for row in batch if segment.matches(*row[1:], now))
+    return users
+
+
+async def estimate_segment(segment: Segment) -> int:
+    if segment.key == 'all':
+        return await user_count()
+    return ACTIVITY.estimate(segment, time.time())
+
+
+class Broadcast:
+    """Sends one text to every user, checkpointing a cursor so it can resume.
+
+    Users are walked in ascending id order with up to ``BROADCAST_WINDOW``
+    sends queued at once. The cursor is the highest id below which every
+    send has finished, whatever order they completed in.
+    """
+
+    def __init__(self, bot, state: dict):
+        self.bot = bot
+        self.state = state
+        self.limiter = RateLimiter(BROADCAST_RATE, BROADCAST_PER_CHAT_INTERVAL)
+        self._semaphore = asyncio.Semaphore(BROADCAST_WORKERS)
+        self._started = time.monotonic()
+        self._sent_at_start = state['sent']
+        self._users = []
+        self._inflight = {}
+        self._dispatched = 0
+        self._cancelled = False
+
+    @classmethod
+    def create(cls, bot, text: str, admin_chat_id: int, progress_message_id: int, total: int, segment: str = 'all'):
+        state = {
+            'text': text,
+            'segment': segment,
+            'admin_chat_id': admin_chat_id,
+            'progress_message_id': progress_message_id,
+            'id': secrets.token_hex(8),
+            'cursor': None,
+            'total': total,
+            'sent': 0,
+            'failed': 0,
+            'pruned': 0,
+        }
+        return cls(bot, state)
+
+    async def save_state(self, state) -> None:
+        await storage_write(STORAGE.set_meta, 'broadcast', state)
+
+    async def _send(self, user_id: int) -> None:
+        async with self._semaphore:
+            try:
+                await self._deliver(user_id)
+            finally:
+                self.limiter.forget(user_id)
+
+    async def _deliver(self, user_id: int) -> None:
+        for attempt in range(BROADCAST_MAX_ATTEMPTS):
+            await self.limiter.wait(user_id)
+            try:
+                await self.bot.send_message(chat_id=user_id, text=self.state['text'])
+                self.state['sent'] += 1
+                BROADCAST_MESSAGES.inc(result='sent')
+                return
+            except RetryAfter as e:
+                BROADCAST_MESSAGES.inc(result='retry_after')
+                self.limiter.bucket.pause(retry_after_seconds(e))
+            except Forbidden:
+                await self._prune(user_id)
+                return
+            except BadRequest as e:
+                if 'chat not found' in e.message.lower():
+                    await self._prune(user_id)
+                else:
+                    self.state['failed'] += 1
+                    BROADCAST_MESSAGES.inc(result='failed')
+                return
+            except TimedOut:
+                # The message may well have been delivered; a retry risks a duplicate.
+                break
+            except NetworkError:
+                if attempt + 1 < BROADCAST_MAX_ATTEMPTS:
+                    await asyncio.sleep(min(2 ** attempt, BROADCAST_MAX_BACKOFF))
+            except TelegramError:
+                break
+        self.state['failed'] += 1
+        BROADCAST_MESSAGES.inc(result='failed')
+
+    async def _prune(self, user_id: int) -> None:
+        await forget_user(user_id)
+        self.state['pruned'] += 1
+        BROADCAST_MESSAGES.inc(result='pruned')
+
+    def progress_text(self, done: bool = False) -> str:
+        state = self.state
+        elapsed = max(time.monotonic() - self._started, 0.001)
+        rate = (state['sent'] - self._sent_at_start) / elapsed
+        processed = state['sent'] + state['failed'] + state['pruned']
+        if not done:
+            header = "📣 در حال ارسال پیام همگانی..."
+        elif self._cancelled:
+            header = "⏹️ ارسال همگانی لغو شد"
+        else:
+            header = "✅ ارسال همگانی به پایان رسید"
+        segment = BROADCAST_SEGMENTS.get(state.get('segment'), BROADCAST_SEGMENTS['all'])
+        return (
+            f"{header}\n\n"
+            f"• مخاطبان: {segment.title}\n"
+            f"• پیشرفت: {processed}/{state['total']}\n"
+            f"• ارسال‌شده: {state['sent']}\n"
+            f"• ناموفق: {state['failed']}\n"
+            f"• حذف‌شده (ربات را مسدود کرده‌اند): {state['pruned']}\n"
+            f"• سرعت: {rate:.1f} پیام در ثانیه"
+        )
+
+    async def _report_progress(self, done: bool = False) -> None:
+        try:
+            await self.bot.edit_message_text(
+                chat_id=self.state['admin_chat_id'],
+                message_id=self.state['progress_message_id'],
+                text=self.progress_text(done),
+            )
+        except TelegramError:
+            pass
+
+    async def _progress_loop(self) -> None:
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await self._checkpoint()
+            await self._report_progress()
+
+    async def _checkpoint(self) -> None:
+        if self.state.get('id') and await EXECUTOR.run(STORAGE.get_meta, 'broadcast_cancelled') == self.state['id']:
+            # Cancelled from the admin panel, possibly by another worker.
+            self._cancelled = True
+            return
+        lowest = min(self._inflight.values(), default=self._dispatched)
+        if lowest > 0:
+            self.state['cursor'] = self._users[lowest - 1]
+        self.state['updated_at'] = time.time()
+        await self.save_state(dict(self.state))
+
+    async def run(self) -> None:
+        cursor = self.state['cursor']
+        segment = BROADCAST_SEGMENTS.get(self.state.get('segment'), BROADCAST_SEGMENTS['all'])
+        if segment.key != 'all':
+            # Segments filter on stored last-seen times; write this worker's pending ones first.
+            USERS.flush()
+            all_users = await EXECUTOR.run(segment_users, segment, time.time())
+        elif STATE.shared:
+            # Other workers may have registered users this process has not seen.
+            all_users = sorted(await EXECUTOR.run(STORAGE.load_users))
+        else:
+            all_users = USERS.snapshot()
+        users = [u for u in all_users if cursor is None or u > cursor]
+        if cursor is None:
+            # The admin was shown an estimate; from here on progress is against the real audience.
+            self.state['total'] = len(users)
+        self._users = users
+        await self._checkpoint()
+        progress_task = asyncio.create_task(self._progress_loop())
+        try:
+            for index, user_id in enumerate(users):
+                while len(self._inflight) >= BROADCAST_WINDOW:
+                    finished, _ = await asyncio.wait(self._inflight, return_when=asyncio.FIRST_COMPLETED)
+                    for task in finished:
+                        del self._inflight[task]
+                        task.result()
+                if self._cancelled:
+                    break
+                self._inflight[asyncio.ensure_future(self._send(user_id))] = index
+                self._dispatched = index + 1
+            for task in list(self._inflight):
+                await task
+                del self._inflight[task]
+        except asyncio.CancelledError:
+            # Cancelled on this worker; the admin still gets the counts so far.
+            self._cancelled = True
+            raise
+        finally:
+            progress_task.cancel()
+            for task in self._inflight:
+                task.cancel()
+            if self._cancelled:
+                # cancel_broadcast has already cleared the stored state.
+                await self._report_progress(done=True)
+        if not self._cancelled:
+            await self.save_state(None)
+            await self._report_progress(done=True)
+
+
+async def _run_broadcast(broadcast: Broadcast) -> None:
+    global ACTIVE_BROADCAST
+    try:
+        await broadcast.run()
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception("Broadcast stopped unexpectedly; it will resume from its cursor on restart")
+    finally:
+        ACTIVE_BROADCAST = None
+
+
+def start_broadcast(broadcast: Broadcast) -> None:
+    global ACTIVE_BROADCAST
+    ACTIVE_BROADCAST = untraced_task(_run_broadcast(broadcast))
+
+
+async def broadcast_in_progress() -> bool:
+    # The stored cursor is visible to every worker, the task handle only to its own process.
+    return ACTIVE_BROADCAST is not None or bool(await EXECUTOR.run(STORAGE.get_meta, 'broadcast'))
+
+
+def broadcast_stalled(state: dict) -> bool:
+    if ACTIVE_BROADCAST is not None:
+        return False
+    if not STATE.shared:
+        # Single process: no task here means nobody is sending.
+        return True
+    return time.time() - state.get('updated_at', 0) > BROADCAST_STALE_AFTER
+
+
+async def show_broadcast_status(query, state: dict):
+    processed = state.get('sent', 0) + state.get('failed', 0) + state.get('pruned', 0)
+    stalled = broadcast_stalled(state)
+    lines = [
+        "📣 یک پیام همگانی در جریان است.",
+        f"• پیشرفت: {processed}/{state.get('total', 0)}",
+    ]
+    rows = [[InlineKeyboardButton("⏹️ لغو ارسال", callback_data='bcast_cancel')]]
+    if stalled:
+        lines.append("⚠️ ارسال متوقف شده است؛ می‌توانید آن را ادامه دهید یا لغو کنید.")
+        rows.append([InlineKeyboardButton("▶️ ادامه ارسال", callback_data='bcast_resume')])
+    rows.append([InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')])
+    await query.edit_message_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(rows))
+
+
+async def cancel_broadcast(query, context: ContextTypes.DEFAULT_TYPE):
+    state = await EXECUTOR.run(STORAGE.get_meta, 'broadcast')
+    if state and state.get('id'):
+        # A sender on another worker sees this at its next checkpoint and stops.
+        await storage_write(STORAGE.set_meta, 'broadcast_cancelled', state['id'])
+    task = ACTIVE_BROADCAST
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    await storage_write(STORAGE.set_meta, 'broadcast', None)
+    await query.edit_message_text("⏹️ ارسال همگانی لغو شد.", reply_markup=MENUS.back_to_admin)
+
+
+async def resume_broadcast(query, context: ContextTypes.DEFAULT_TYPE):
+    state = await EXECUTOR.run(STORAGE.get_meta, 'broadcast')
+    if not state or not broadcast_stalled(state):
+        await query.answer("⏳ ارسال همگانی در حال اجراست یا وجود ندارد", show_alert=True)
+        return
+    logger.info("Resuming stalled broadcast after user id %s", state['cursor'])
+    start_broadcast(Broadcast(context.bot, state))
+    await query.edit_message_text("▶️ ارسال همگانی ادامه یافت.", reply_markup=MENUS.back_to_admin)
+
+
 async def admin_broadcast(query, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data['awaiting'] = 'broadcast_message'
+    state = await EXECUTOR.run(STORAGE.get_meta, 'broadcast')
+    if state or ACTIVE_BROADCAST is not None:
+        await show_broadcast_status(query, state or {})
+        return
+    rows = []
+    for segment in BROADCAST_SEGMENTS.values():
+        count = await estimate_segment(segment)
+        rows.append([InlineKeyboardButton(f"{segment.title} (≈{count})", callback_data=f'bcast_{segment.key}')])
+    rows.append([InlineKeyboardButton("لغو", callback_data='admin_panel')])
     await query.edit_message_text(
-        "📣 متن پیام همگانی را ارسال کنید.",
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("لغو", callback_data='admin_panel')]])
+        "📣 مخاطبان پیام همگانی را انتخاب کنید:",
+        reply_markup=InlineKeyboardMarkup(rows)
     )
 
 
+async def select_broadcast_segment(query, context: ContextTypes.DEFAULT_TYPE, key: str):
+    segment = BROADCAST_SEGMENTS.get(key)
+    if segment is None:
+        await query.answer("⚠️ یافت نشد")
+        return
+    await STATE.set_conversation(query.from_user.id, {'awaiting': 'broadcast_message', 'segment': key})
+    await query.edit_message_text(
+        f"📣 متن پیام همگانی برای «{segment.title}» (حدود {await estimate_segment(segment)} کاربر) را ارسال کنید.",
+        reply_markup=MENUS.cancel_to_admin
+    )
+
+
+EXPORT_FORMATS = ('txt', 'csv', 'jsonl')
+EXPORT_HEADERS = {'csv': "user_id,registered_at,last_seen,language\n"}
+
+
+def _export_timestamp(ts) -> str:
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).isoformat() if ts else ''
+
+
+def format_export_row(fmt: str, user_id: int, registered_at, last_seen, language) -> str:
+    if fmt == 'csv':
+        return f"{user_id},{_export_timestamp(registered_at)},{_export_timestamp(last_seen)},{language or ''}\n"
+    if fmt == 'jsonl':
+        return json.dumps({
+            'user_id': user_id,
+            'registered_at': _export_timestamp(registered_at) or None,
+            'last_seen': _export_timestamp(last_seen) or None,
+            'language': language,
+        }) + "\n"
+    return f"{user_id}\n"
+
+
+class ExportWriter:
+    """Writes export rows into numbered part files, starting a new part before one would pass ``part_limit`` bytes."""
+
+    def __init__(self, directory: str, fmt: str, compress: bool, part_limit: int):
+        self.directory = directory
+        self.fmt = fmt
+        self.compress = compress
+        self.part_limit = part_limit
+        self.paths = []
+        self._raw = None
+        self._out = None
+        self._part_rows = 0
+
+    def _open_part(self) -> None:
+        self.close_part()
+        suffix = f".{self.fmt}.gz" if self.compress else f".{self.fmt}"
+        path = os.path.join(self.directory, f"users-{len(self.paths) + 1}{suffix}")
+        self.paths.append(path)
+        self._raw = open(path, 'wb')
+        self._out = gzip.GzipFile(fileobj=self._raw, mode='wb') if self.compress else self._raw
+        self._part_rows = 0
+        header = EXPORT_HEADERS.get(self.fmt)
+        if header:
+            self._out.write(header.encode('utf-8'))
+
+    def write(self, line: str) -> None:
+        data = line.encode('utf-8')
+        # On-disk size of a gzip part lags what was written by whatever zlib still buffers.
+        if self._out is None or (self._part_rows and self._raw.tell() + len(data) > self.part_limit):
+            self._open_part()
+        self._out.write(data)
+        self._part_rows += 1
+
+    def close_part(self) -> None:
+        if self._out is not None:
+            self._out.close()
+            if self._out is not self._raw:
+                self._raw.close()
+            self._out = self._raw = None
+
+    def close(self) -> list:
+        if self._out is None and not self.paths:
+            self._open_part()
+        self.close_part()
+        return self.paths
+
+
+def write_users_export(directory: str, fmt: str, compress: bool) -> tuple:
+    writer = ExportWriter(directory, fmt, compress, EXPORT_PART_LIMIT)
+    count = 0
+    try:
+        for batch in STORAGE.iter_users(USER_SCAN_BATCH_SIZE):
+            for row in batch:
+                writer.write(format_export_row(fmt, *row))
+            count += len(batch)
+    finally:
+        paths = writer.close()
+    return paths, count
+
+
 async def admin_export_users(query, context: ContextTypes.DEFAULT_TYPE):
-    users = load_users()
-    content = "\n".join(str(u) for u in users)
-    bio = BytesIO(content.encode('utf-8'))
-    bio.name = 'users.txt'
-    await context.bot.send_document(chat_id=query.message.chat.id, document=bio, filename='users.txt', caption=f"تعداد کاربران: {len(users)}")
-    await query.answer("✅ فایل کاربران ارسال شد")
+    await query.edit_message_text("📤 قالب فایل خروجی را انتخاب کنید:", reply_markup=MENUS.export_formats)
+
+
+async def perform_export_users(query, context: ContextTypes.DEFAULT_TYPE, choice: str):
+    fmt, _, compression = choice.partition('.')
+    if fmt not in EXPORT_FORMATS or compression not in ('', 'gz'):
+        await query.edit_message_text("⚠️ قالب نامعتبر", reply_markup=MENUS.back_to_admin)
+        return
+    await query.edit_message_text("⏳ در حال آماده‌سازی فایل کاربران...")
+    with tempfile.TemporaryDirectory(prefix='azadi-export-') as directory:
+        # Rows stream from storage to disk in batches; only one part is ever uploaded at a time.
+        paths, count = await EXECUTOR.run(write_users_export, directory, fmt, compression == 'gz')
+        for i, path in enumerate(paths, 1):
+            caption = f"تعداد کاربران: {count}"
+            if len(paths) > 1:
+                caption += f" — بخش {i} از {len(paths)}"
+            with open(path, 'rb') as f:
+                await context.bot.send_document(
+                    chat_id=query.message.chat.id, document=f, filename=os.path.basename(path), caption=caption
+                )
+    await query.edit_message_text("✅ فایل کاربران ارسال شد", reply_markup=MENUS.back_to_admin)
 
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    global MESSAGE_COUNT
-    MESSAGE_COUNT += 1
+    COUNTERS.incr('messages')
 
-    user_id = update.effective_user.id if update.effective_user else None
-    if update.effective_user:
-        register_user(update.effective_user.id)
+    if not update.effective_user:
+        return
+    user_id = update.effective_user.id
+    await register_user(user_id)
 
-    awaiting = context.user_data.get('awaiting')
+    conversation = await STATE.get_conversation(user_id)
+    awaiting = conversation.get('awaiting')
     if not awaiting:
         return
 
+    if awaiting == 'server_search':
+        await STATE.clear_conversation(user_id)
+        removing = conversation.get('catalog') == 'remove' and is_admin(user_id)
+        await reply_catalog_search(update, MENUS.remove_catalog if removing else MENUS.server_catalog)
+        return
+
     if not is_admin(user_id):
         await update.message.reply_text("⛔ فقط مدیر می‌تواند از این بخش استفاده کند.")
-        context.user_data.pop('awaiting', None)
-        context.user_data.pop('new_config', None)
+        await STATE.clear_conversation(user_id)
         return
 
     if awaiting == 'add_config_name':
-        context.user_data['new_config'] = context.user_data.get('new_config', {})
-        context.user_data['new_config']['name'] = update.message.text.strip()
-        context.user_data['awaiting'] = 'add_config_url'
+        new_config = conversation.get('new_config', {})
+        new_config['name'] = update.message.text.strip()
+        await STATE.set_conversation(user_id, {'awaiting': 'add_config_url', 'new_config': new_config})
         await update.message.reply_text(
             "لینک کانفیگ را ارسال کنید (vless://, trojan://, vmess://, ss://, ...)",
         )
@@ -610,28 +2388,34 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         if not validate_config_url(config_url):
             await update.message.reply_text("❌ لینک نامعتبر است. دوباره تلاش کنید یا لغو کنید.")
             return
-        name = context.user_data.get('new_config', {}).get('name', 'New Config')
+        if config_url_key(config_url) in {config_url_key(cfg['config']) for cfg in CONFIGS.values()}:
+            await update.message.reply_text("⚠️ این کانفیگ قبلاً ثبت شده است. لینک دیگری بفرستید یا لغو کنید.")
+            return
+        name = conversation.get('new_config', {}).get('name', 'New Config')
         new_id = generate_config_id(name)
-        CONFIGS[new_id] = {'name': name, 'config': config_url}
-        save_json_file(CONFIGS_FILE, CONFIGS)
-        context.user_data.pop('awaiting', None)
-        context.user_data.pop('new_config', None)
+        await save_config(new_id, {'name': name, 'config': config_url})
+        await STATE.clear_conversation(user_id)
         await update.message.reply_text(f"✅ با موفقیت اضافه شد: {name} ({new_id})")
         await show_admin_panel_from_message(update)
         return
 
+    if awaiting == 'bulk_import':
+        await import_configs(update, update.message.text)
+        return
+
     if awaiting == 'broadcast_message':
-        text = update.message.text
-        users = load_users()
-        sent = 0
-        for uid in users:
-            try:
-                await context.bot.send_message(chat_id=uid, text=text)
-                sent += 1
-            except Exception:
-                pass
-        context.user_data.pop('awaiting', None)
-        await update.message.reply_text(f"✅ ارسال شد برای {sent} کاربر")
+        await STATE.clear_conversation(user_id)
+        if await broadcast_in_progress():
+            await update.message.reply_text("⏳ یک پیام همگانی در حال ارسال است.")
+            return
+        segment = BROADCAST_SEGMENTS.get(conversation.get('segment'), BROADCAST_SEGMENTS['all'])
+        progress = await update.message.reply_text("📣 در حال آماده‌سازی پیام همگانی...")
+        broadcast = Broadcast.create(
+            context.bot, update.message.text, progress.chat_id, progress.message_id,
+            await estimate_segment(segment), segment.key,
+        )
+        await broadcast.save_state(dict(broadcast.state))
+        start_broadcast(broadcast)
         await show_admin_panel_from_message(update)
         return
 
@@ -641,6 +2425,104 @@ def validate_config_url(config_url: str) -> bool:
     return any(config_url.startswith(p) for p in allowed)
 
 
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    if user is None or not is_admin(user.id):
+        return
+    conversation = await STATE.get_conversation(user.id)
+    if conversation.get('awaiting') != 'bulk_import':
+        return
+    document = update.message.document
+    if document.file_size and document.file_size > BULK_IMPORT_MAX_BYTES:
+        await update.message.reply_text(f"❌ حجم فایل بیش از {BULK_IMPORT_MAX_BYTES // (1024 * 1024)} مگابایت است.")
+        return
+    telegram_file = await document.get_file()
+    payload = await telegram_file.download_as_bytearray()
+    await import_configs(update, payload.decode('utf-8', errors='replace'))
+
+
+def config_url_key(config_url: str) -> str:
+    # The fragment is only a display name; two links differing there are the same server.
+    return config_url.split('#', 1)[0].strip()
+
+
+def split_import_payload(text: str) -> list:
+    text = text.strip().lstrip('\ufeff')
+    if '://' not in text:
+        try:
+            text = b64decode(''.join(text.split()))
+        except (ValueError, UnicodeDecodeError):
+            pass
+    return text.split()
+
+
+def config_name_from_url(config_url: str) -> str:
+    parsed = parse_config_url(config_url)
+    if parsed.link_name.strip():
+        return parsed.link_name.strip()[:64]
+    label = parsed.protocol.upper()
+    return f"{label} - {parsed.host}" if parsed.known else label
+
+
+def bulk_config_id(name: str, config_url: str, taken) -> str:
+    # Deterministic and short enough that 'admin_remove_<id>' stays within Telegram's 64-byte callback_data.
+    base = ''.join(ch for ch in name.lower() if ch.isascii() and (ch.isalnum() or ch in ('_', '-'))).strip('-_')
+    base = base[:24] or 'cfg'
+    digest = hashlib.sha1(config_url_key(config_url).encode('utf-8')).hexdigest()
+    for size in range(6, len(digest) + 1, 2):
+        candidate = f"{base}_{digest[:size]}"
+        if candidate not in taken:
+            return candidate
+    return generate_config_id(name)
+
+
+class ImportPlan:
+    __slots__ = ('configs', 'duplicates', 'invalid')
+
+    def __init__(self):
+        self.configs = {}
+        self.duplicates = 0
+        self.invalid = []
+
+
+def plan_config_import(text: str, existing: dict) -> ImportPlan:
+    plan = ImportPlan()
+    index = {config_url_key(cfg['config']) for cfg in existing.values()}
+    taken = set(existing)
+    for config_url in split_import_payload(text):
+        if not validate_config_url(config_url):
+            plan.invalid.append(config_url)
+            continue
+        key = config_url_key(config_url)
+        if key in index:
+            plan.duplicates += 1
+            continue
+        index.add(key)
+        name = config_name_from_url(config_url)
+        cfg_id = bulk_config_id(name, config_url, taken)
+        taken.add(cfg_id)
+        plan.configs[cfg_id] = {'name': name, 'config': config_url}
+    return plan
+
+
+async def import_configs(update: Update, text: str) -> None:
+    plan = await EXECUTOR.run(plan_config_import, text, dict(CONFIGS))
+    await STATE.clear_conversation(update.effective_user.id)
+    if plan.configs:
+        await save_configs(plan.configs)
+    lines = [
+        "📥 نتیجه ورود گروهی:\n",
+        f"• افزوده شد: {len(plan.configs)}",
+        f"• تکراری: {plan.duplicates}",
+        f"• نامعتبر: {len(plan.invalid)}",
+    ]
+    if plan.invalid:
+        lines.append("\nنمونه موارد نامعتبر:")
+        lines.extend(f"• {entry[:60]}" for entry in plan.invalid[:5])
+    await update.message.reply_text("\n".join(lines)[:4096])
+    await show_admin_panel_from_message(update)
+
+
 def generate_config_id(name: str) -> str:
     base = ''.join(ch for ch in name.lower() if ch.isalnum() or ch in ('_', '-')).strip('-_')
     if not base:
@@ -653,16 +2535,795 @@ def generate_config_id(name: str) -> str:
     return candidate
 
 
-def main() -> None:
-    application = Application.builder().token(TOKEN).build()
+class FloodGuard:
+    """Per-user token buckets plus suppression of repeated identical callbacks/messages."""
+
+    def __init__(self, rate: float, burst: float, duplicate_window: float):
+        self.rate = rate
+        self.burst = burst
+        self.duplicate_window = duplicate_window
+        self.throttled = Counter()
+        self._buckets = {}
+        self._recent = {}
+        self._notified = {}
+        self._last_sweep = time.monotonic()
+
+    def _sweep(self, now: float) -> None:
+        # A bucket that has refilled is indistinguishable from a new one.
+        self._buckets = {uid: b for uid, b in self._buckets.items() if not b.is_full(now)}
+        self._recent = {key: ts for key, ts in self._recent.items() if now - ts < self.duplicate_window}
+        self._notified = {uid: ts for uid, ts in self._notified.items() if now - ts < FLOOD_NOTICE_INTERVAL}
+        self._last_sweep = now
+
+    def check(self, user_id: int, fingerprint) -> str:
+        now = time.monotonic()
+        if now - self._last_sweep > FLOOD_SWEEP_INTERVAL:
+            self._sweep(now)
+        key = (user_id, fingerprint)
+        last_seen = self._recent.get(key)
+        self._recent[key] = now
+        if last_seen is not None and now - last_seen < self.duplicate_window:
+            self.throttled['duplicate'] += 1
+            return 'duplicate'
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        if not bucket.try_acquire():
+            self.throttled['rate'] += 1
+            return 'rate'
+        return ''
+
+    def should_notify(self, user_id: int) -> bool:
+        now = time.monotonic()
+        if now - self._notified.get(user_id, 0.0) < FLOOD_NOTICE_INTERVAL:
+            return False
+        self._notified[user_id] = now
+        return True
+
+
+FLOOD = FloodGuard(FLOOD_RATE, FLOOD_BURST, FLOOD_DUPLICATE_WINDOW)
+METRICS.callback(
+    'azadi_throttled_updates_total', "Updates dropped by flood control", 'counter',
+    lambda: {(reason,): count for reason, count in FLOOD.throttled.items()}, ('reason',),
+)
+
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    if user is None:
+        return
+    if user.id not in USERS:
+        if STATE.shared and await STATE.has_user(user.id):
+            USERS.adopt(user.id)
+        elif update.message is not None and update.message.text:
+            # Text messages (/start included) register a user anyway.
+            await register_user(user.id)
+        else:
+            # Strangers, e.g. sending inline queries, must not count toward broadcast segments.
+            return
+    language = normalize_language(user.language_code)
+    USERS.touch(user.id, language)
+    ACTIVITY.record(user.id, time.time(), language)
+
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    if user is None or is_admin(user.id):
+        return
+    query = update.callback_query
+    if query is not None:
+        fingerprint = ('cb', query.data, query.message.message_id if query.message else None)
+    elif update.message is not None:
+        fingerprint = ('msg', update.message.text)
+    else:
+        return
+
+    verdict = FLOOD.check(user.id, fingerprint)
+    if not verdict:
+        return
+    if query is not None:
+        # Always answer so the client stops its spinner; only say why once in a while.
+        if verdict == 'rate' and FLOOD.should_notify(user.id):
+            await query.answer("⏳ لطفاً کمی آهسته‌تر!")
+        else:
+            await query.answer()
+    elif verdict == 'rate' and FLOOD.should_notify(user.id):
+        await update.message.reply_text("⏳ درخواست‌های شما زیاد است، لطفاً چند لحظه صبر کنید.")
+    raise ApplicationHandlerStop
+
+
+class Route:
+    __slots__ = ('name', 'handler', 'instrumented', 'takes_context', 'admin_only', 'parse', 'answers')
+
+    def __init__(self, name, handler, takes_context=False, admin_only=False, parse=None, answers=False):
+        self.name = name
+        self.handler = handler
+        self.instrumented = instrumented(f"callback:{name}", handler)
+        self.takes_context = takes_context
+        self.admin_only = admin_only
+        self.parse = parse
+        self.answers = answers
+
+
+class AnsweredQuery:
+    """Wraps a CallbackQuery and records whether the handler answered it.
+
+    Telegram accepts one answer per query, so the router only answers on a
+    route's behalf when the route did not.
+    """
+
+    __slots__ = ('query', 'answered')
+
+    def __init__(self, query):
+        self.query = query
+        self.answered = False
+
+    def __getattr__(self, name):
+        return getattr(self.query, name)
+
+    async def answer(self, *args, **kwargs):
+        self.answered = True
+        return await self.query.answer(*args, **kwargs)
+
+
+class CallbackRouter:
+    """Maps callback_data to handlers: exact keys via dict, parameterized ones via a prefix trie.
+
+    Exact keys win over prefixes, and among prefixes the longest match wins,
+    so 'copy_sublink' and 'admin_remove_config' are not shadowed by 'copy_'
+    and 'admin_remove_'.
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._trie = {}
+        self.hits = Counter()
+
+    def exact(self, key: str, handler, **options) -> None:
+        self._exact[key] = Route(key, handler, **options)
+
+    def prefix(self, prefix: str, handler, parse=str, **options) -> None:
+        node = self._trie
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        node[None] = Route(prefix, handler, parse=parse, **options)
+
+    def resolve(self, data: str):
+        route = self._exact.get(data)
+        if route is not None:
+            return route, None
+        node = self._trie
+        match = None
+        for i, ch in enumerate(data):
+            node = node.get(ch)
+            if node is None:
+                break
+            if None in node:
+                match = (node[None], i + 1)
+        if match is None:
+            return None, None
+        route, end = match
+        return route, data[end:]
+
+    async def dispatch(self, query, context: ContextTypes.DEFAULT_TYPE) -> None:
+        route, raw_arg = self.resolve(query.data or '')
+        if route is None:
+            await query.answer()
+            return
+        if route.admin_only and not is_admin(query.from_user.id):
+            await query.answer("⛔ دسترسی ندارید", show_alert=True)
+            return
+        if not route.answers:
+            # Stop the client's spinner before the handler does any slow work.
+            await query.answer()
+        else:
+            query = AnsweredQuery(query)
+        args = [query]
+        if route.takes_context:
+            args.append(context)
+        if route.parse is not None:
+            try:
+                args.append(route.parse(raw_arg))
+            except ValueError:
+                if route.answers:
+                    await query.answer()
+                return
+        self.hits[route.name] += 1
+        try:
+            await route.instrumented(*args)
+        finally:
+            if route.answers and not query.answered:
+                await query.answer()
+
+
+def build_router() -> CallbackRouter:
+    router = CallbackRouter()
+    router.exact('sublink', show_sublink)
+    router.exact('servers', show_servers_menu)
+    router.exact('srv_filters', show_server_filters)
+    router.exact('srv_search', start_server_search)
+    router.exact('best_server', show_best_server, takes_context=True, answers=True)
+    router.exact('tools', show_tools_menu)
+    router.exact('clients', show_clients)
+    router.exact('faq', show_faq_menu)
+    router.exact('back', start_from_button)
+    router.exact('copy_sublink', copy_sublink, answers=True)
+    router.exact('ping_test', run_ping_test)
+    router.exact('dns_test', check_dns_leak)
+    router.exact('ip_info', get_user_ip)
+    router.exact('admin_panel', show_admin_panel, takes_context=True, admin_only=True)
+    router.exact('admin_stats', admin_stats, takes_context=True, admin_only=True)
+    router.exact('admin_list_configs', admin_list_configs, takes_context=True, admin_only=True)
+    router.exact('admin_add_config', admin_add_config, takes_context=True, admin_only=True)
+    router.exact('admin_bulk_import', admin_bulk_import, takes_context=True, admin_only=True)
+    router.exact('admin_remove_config', admin_remove_config, takes_context=True, admin_only=True)
+    router.exact('admin_rmpage_filters', admin_remove_filters, takes_context=True, admin_only=True)
+    router.exact('admin_rmpage_search', admin_remove_search, takes_context=True, admin_only=True)
+    router.exact('admin_broadcast', admin_broadcast, takes_context=True, admin_only=True)
+    router.exact('admin_export_users', admin_export_users, takes_context=True, admin_only=True)
+    router.exact('admin_slow', admin_slow_paths, takes_context=True, admin_only=True)
+    router.prefix('config_', show_config, takes_context=True, answers=True)
+    router.prefix('copy_', copy_config_value, takes_context=True, answers=True)
+    router.prefix('srv_', show_servers_page, parse=parse_catalog_target)
+    router.prefix('faq_', show_faq_detail, parse=int, answers=True)
+    router.prefix('admin_remove_', perform_remove_config, admin_only=True, answers=True)
+    router.prefix('admin_rmpage_', admin_remove_page, takes_context=True, parse=parse_catalog_target, admin_only=True)
+    # Answered up front: exports outlive the window in which Telegram accepts an answer.
+    router.prefix('admin_export_', perform_export_users, takes_context=True, admin_only=True)
+    router.prefix('bcast_', select_broadcast_segment, takes_context=True, admin_only=True, answers=True)
+    router.exact('bcast_cancel', cancel_broadcast, takes_context=True, admin_only=True)
+    router.exact('bcast_resume', resume_broadcast, takes_context=True, admin_only=True, answers=True)
+    return router
+
+
+ROUTER = build_router()
+
+
+STATE_SYNC_TASK = None
+LOOP_LAG_TASK = None
+METRICS_SERVER = None
+SUBSCRIPTION_SERVER = None
+
+
+async def handle_metrics_request(request):
+    if request.path != '/metrics':
+        return 404, {}, b''
+    body = METRICS.render().encode('utf-8')
+    return 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}, body
+
+
+async def on_startup(application: Application) -> None:
+    global STATE_SYNC_TASK, CONFIGS_VERSION, LOOP_LAG_TASK, METRICS_SERVER, SUBSCRIPTION_SERVER
+    LOOP_LAG_TASK = asyncio.create_task(_loop_lag_monitor())
+    if METRICS_PORT:
+        # One port per worker so each process can be scraped on its own.
+        METRICS_SERVER = await serve_http(METRICS_LISTEN, METRICS_PORT + WORKER_INDEX, handle_metrics_request)
+    await warm_qr_cache([cfg['config'] for cfg in CONFIGS.values()])
+    if SUBSCRIPTION_PORT:
+        await EXECUTOR.run(SUBSCRIPTIONS.rebuild, dict(CONFIGS))
+        SUBSCRIPTION_SERVER = await serve_http(
+            SUBSCRIPTION_LISTEN, SUBSCRIPTION_PORT, SUBSCRIPTIONS.handle, max_connections=1000, reuse_port=WORKERS > 1
+        )
+    if STATE.shared:
+        CONFIGS_VERSION = await STATE.get_counter('configs_version')
+    STATE_SYNC_TASK = asyncio.create_task(_state_sync_loop())
+    if WORKER_INDEX != 0:
+        return
+    if STATE.shared:
+        await STATE.add_users(USERS.snapshot())
+    HEALTH.start()
+    state = STORAGE.get_meta('broadcast')
+    if state:
+        logger.info("Resuming broadcast after user id %s", state['cursor'])
+        start_broadcast(Broadcast(application.bot, state))
+
+
+async def on_stop(application: Application) -> None:
+    for task in (STATE_SYNC_TASK, LOOP_LAG_TASK):
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    for server in (METRICS_SERVER, SUBSCRIPTION_SERVER):
+        if server is not None:
+            await server.close()
+    await HEALTH.stop()
+    if ACTIVE_BROADCAST is not None:
+        ACTIVE_BROADCAST.cancel()
+        await asyncio.gather(ACTIVE_BROADCAST, return_exceptions=True)
+
+
+async def on_shutdown(application: Application) -> None:
+    await COUNTERS.flush()
+    await STATE.close()
+    USERS.flush()
+    # Let queued writes finish before the storage they write to is closed.
+    EXECUTOR.shutdown()
+    STORAGE.close()
+
+
+class HttpRequest:
+    __slots__ = ('method', 'path', 'query', 'headers', 'body')
+
+    def __init__(self, method: str, path: str, query: str, headers: dict, body: bytes):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+
+HTTP_REASONS = {
+    200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 403: 'Forbidden',
+    404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+    500: 'Internal Server Error',
+}
 
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("admin", admin))
+
+async def _read_http_request(reader: asyncio.StreamReader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length') or 0)
+    if length > HTTP_MAX_BODY:
+        raise ValueError("request body too large")
+    body = await reader.readexactly(length) if length else b''
+    path, _, query = target.partition('?')
+    return HttpRequest(method.upper(), path, query, headers, body)
+
+
+def _format_http_response(status: int, headers: dict, body: bytes, keep_alive: bool, head_only: bool) -> bytes:
+    lines = [f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'OK')}"]
+    headers = dict(headers)
+    headers['Content-Length'] = str(len(body))
+    headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+    lines.extend(f"{name}: {value}" for name, value in headers.items())
+    head = ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+    return head if head_only else head + body
+
+
+class HttpServer:
+    """Minimal HTTP/1.1 server with keep-alive.
+
+    ``handler(request)`` returns ``(status, headers, body)``. At most
+    ``max_connections`` connections are served at once; further clients
+    wait until a slot frees up.
+    """
+
+    def __init__(self, handler, max_connections: int = 100):
+        self.handler = handler
+        self._slots = asyncio.Semaphore(max_connections)
+        self._writers = set()
+        self._server = None
+
+    async def start(self, host: str, port: int, reuse_port: bool = False) -> None:
+        self._server = await asyncio.start_server(self._on_connection, host, port, reuse_port=reuse_port or None)
+
+    async def _on_connection(self, reader, writer) -> None:
+        self._writers.add(writer)
+        try:
+            async with self._slots:
+                await self._serve(reader, writer)
+        except ConnectionError:
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _serve(self, reader, writer) -> None:
+        while True:
+            try:
+                request = await asyncio.wait_for(_read_http_request(reader), HTTP_IDLE_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                return
+            except ValueError:
+                writer.write(_format_http_response(400, {}, b'', False, False))
+                return
+            if request is None:
+                return
+            try:
+                status, headers, body = await self.handler(request)
+            except Exception:
+                logger.exception("HTTP handler failed for %s %s", request.method, request.path)
+                status, headers, body = 500, {}, b''
+            keep_alive = request.headers.get('connection', '').lower() != 'close'
+            writer.write(_format_http_response(status, headers, body, keep_alive, request.method == 'HEAD'))
+            await writer.drain()
+            if not keep_alive:
+                return
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        if self._server is not None:
+            await self._server.wait_closed()
+
+
+async def serve_http(host: str, port: int, handler, max_connections: int = 100, reuse_port: bool = False) -> HttpServer:
+    server = HttpServer(handler, max_connections)
+    await server.start(host, port, reuse_port)
+    return server
+
+
+# Protocols both Clash (Meta) and sing-box can express; the base64 feed passes every link through.
+FEED_PROTOCOLS = ('vless', 'vmess', 'trojan', 'ss', 'hysteria2', 'tuic')
+
+
+def clash_proxy(name: str, p: ParsedConfig) -> dict:
+    proxy = {'name': name, 'type': p.protocol, 'server': p.host, 'port': p.port, 'udp': True}
+    if p.protocol == 'ss':
+        proxy.update(cipher=p.cipher, password=p.password)
+        return proxy
+    if p.protocol == 'vmess':
+        proxy.update(uuid=p.uuid, alterId=p.alter_id, cipher=p.cipher)
+    elif p.protocol == 'vless':
+        proxy['uuid'] = p.uuid
+        if p.flow:
+            proxy['flow'] = p.flow
+    elif p.protocol == 'tuic':
+        proxy.update(uuid=p.uuid, password=p.password)
+    else:
+        proxy['password'] = p.password
+    if p.alpn:
+        proxy['alpn'] = p.alpn.split(',')
+    if p.protocol == 'hysteria2':
+        if p.obfs:
+            proxy.update({'obfs': p.obfs, 'obfs-password': p.obfs_password})
+    elif p.transport != 'tcp':
+        proxy['network'] = p.transport
+        if p.transport == 'ws':
+            proxy['ws-opts'] = {'path': p.path or '/', **({'headers': {'Host': p.ws_host}} if p.ws_host else {})}
+        elif p.transport == 'grpc':
+            proxy['grpc-opts'] = {'grpc-service-name': p.service_name}
+    if p.protocol in ('vmess', 'vless'):
+        proxy['tls'] = p.tls
+        if p.sni:
+            proxy['servername'] = p.sni
+    elif p.sni:
+        proxy['sni'] = p.sni
+    if p.insecure:
+        proxy['skip-cert-verify'] = True
+    if p.fingerprint:
+        proxy['client-fingerprint'] = p.fingerprint
+    if p.reality:
+        proxy['reality-opts'] = {'public-key': p.public_key, 'short-id': p.short_id}
+    return proxy
+
+
+def singbox_outbound(name: str, p: ParsedConfig) -> dict:
+    outbound = {'type': {'ss': 'shadowsocks'}.get(p.protocol, p.protocol), 'tag': name,
+                'server': p.host, 'server_port': p.port}
+    if p.protocol == 'ss':
+        outbound.update(method=p.cipher, password=p.password)
+        return outbound
+    if p.protocol == 'vmess':
+        outbound.update(uuid=p.uuid, alter_id=p.alter_id, security=p.cipher)
+    elif p.protocol == 'vless':
+        outbound['uuid'] = p.uuid
+        if p.flow:
+            outbound['flow'] = p.flow
+    elif p.protocol == 'tuic':
+        outbound.update(uuid=p.uuid, password=p.password)
+    else:
+        outbound['password'] = p.password
+    if p.protocol == 'hysteria2':
+        if p.obfs:
+            outbound['obfs'] = {'type': p.obfs, 'password': p.obfs_password}
+    elif p.transport == 'ws':
+        outbound['transport'] = {'type': 'ws', 'path': p.path or '/',
+                                 **({'headers': {'Host': p.ws_host}} if p.ws_host else {})}
+    elif p.transport == 'grpc':
+        outbound['transport'] = {'type': 'grpc', 'service_name': p.service_name}
+    if p.tls:
+        tls = {'enabled': True}
+        if p.sni:
+            tls['server_name'] = p.sni
+        if p.insecure:
+            tls['insecure'] = True
+        if p.alpn:
+            tls['alpn'] = p.alpn.split(',')
+        if p.fingerprint:
+            tls['utls'] = {'enabled': True, 'fingerprint': p.fingerprint}
+        if p.reality:
+            tls['reality'] = {'enabled': True, 'public_key': p.public_key, 'short_id': p.short_id}
+        outbound['tls'] = tls
+    return outbound
+
+
+def _feed_entries(configs: dict):
+    # Clients key proxies by name, so duplicates get their config id appended.
+    seen = set()
+    for cfg_id, cfg in configs.items():
+        name = cfg['name'] if cfg['name'] not in seen else f"{cfg['name']} ({cfg_id})"
+        seen.add(name)
+        yield name, cfg, PARSED.get(cfg_id, cfg)
+
+
+def render_base64_feed(configs: dict) -> bytes:
+    links = [with_link_name(cfg['config'], name) for name, cfg, _ in _feed_entries(configs)]
+    return base64.b64encode("\n".join(links).encode('utf-8'))
+
+
+def render_clash_feed(configs: dict) -> bytes:
+    proxies = []
+    for name, _, parsed in _feed_entries(configs):
+        if parsed.known and parsed.protocol in FEED_PROTOCOLS:
+            proxies.append(clash_proxy(name, parsed))
+    names = [proxy['name'] for proxy in proxies]
+    # JSON flow mappings are valid YAML, which keeps PyYAML out of the dependencies.
+    dump = lambda value: json.dumps(value, ensure_ascii=False)
+    lines = ["proxies:"] + [f"  - {dump(proxy)}" for proxy in proxies]
+    lines += [
+        "proxy-groups:",
+        f"  - {dump({'name': SUBSCRIPTION_PROFILE_NAME, 'type': 'select', 'proxies': ['auto'] + names})}",
+        f"  - {dump({'name': 'auto', 'type': 'url-test', 'proxies': names, 'url': 'https://www.gstatic.com/generate_204', 'interval': 300})}",
+        "rules:",
+        f"  - {dump('MATCH,' + SUBSCRIPTION_PROFILE_NAME)}",
+    ]
+    return ("\n".join(lines) + "\n").encode('utf-8')
+
+
+def render_singbox_feed(configs: dict) -> bytes:
+    outbounds = []
+    for name, _, parsed in _feed_entries(configs):
+        if parsed.known and parsed.protocol in FEED_PROTOCOLS:
+            outbounds.append(singbox_outbound(name, parsed))
+    tags = [outbound['tag'] for outbound in outbounds]
+    document = {'outbounds': [
+        {'type': 'selector', 'tag': SUBSCRIPTION_PROFILE_NAME, 'outbounds': ['auto'] + tags},
+        {'type': 'urltest', 'tag': 'auto', 'outbounds': tags},
+        *outbounds,
+        {'type': 'direct', 'tag': 'direct'},
+    ]}
+    return json.dumps(document, ensure_ascii=False, indent=2).encode('utf-8')
+
+
+SUBSCRIPTION_FEEDS = {
+    '': (render_base64_feed, 'text/plain; charset=utf-8'),
+    '/clash': (render_clash_feed, 'text/yaml; charset=utf-8'),
+    '/singbox': (render_singbox_feed, 'application/json; charset=utf-8'),
+}
+SUBSCRIPTION_REQUESTS = METRICS.counter(
+    'azadi_subscription_requests_total', "Subscription feed requests by feed and status", ('feed', 'status')
+)
+
+
+class FeedResponse:
+    __slots__ = ('body', 'gzipped', 'etag', 'content_type')
+
+    def __init__(self, body: bytes, content_type: str):
+        self.body = body
+        self.gzipped = gzip.compress(body, mtime=0)
+        self.etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        self.content_type = content_type
+
+
+class SubscriptionFeeds:
+    """Subscription bodies rendered once per config change, with their gzip form and ETag.
+
+    Serving a request is a dict lookup plus a header comparison, so clients
+    that poll every few minutes mostly get a bodiless 304.
+    """
+
+    def __init__(self, base_path: str):
+        self.base_path = base_path.rstrip('/')
+        self.responses = {}
+
+    def rebuild(self, configs: dict) -> None:
+        responses = {}
+        for suffix, (render, content_type) in SUBSCRIPTION_FEEDS.items():
+            responses[(self.base_path + suffix) or '/'] = FeedResponse(render(configs), content_type)
+        self.responses = responses
+
+    async def handle(self, request: HttpRequest):
+        feed = self.responses.get(request.path.rstrip('/') or '/')
+        if feed is None:
+            return 404, {}, b''
+        name = request.path[len(self.base_path):].strip('/') or 'base64'
+        if request.method not in ('GET', 'HEAD'):
+            return 405, {'Allow': 'GET, HEAD'}, b''
+        headers = {
+            'ETag': feed.etag,
+            'Cache-Control': f'public, max-age={SUBSCRIPTION_MAX_AGE}',
+            'Vary': 'Accept-Encoding',
+            'Profile-Update-Interval': str(SUBSCRIPTION_UPDATE_INTERVAL_HOURS),
+        }
+        if_none_match = request.headers.get('if-none-match', '')
+        if if_none_match.strip() == '*' or feed.etag in (tag.strip() for tag in if_none_match.split(',')):
+            SUBSCRIPTION_REQUESTS.inc(feed=name, status='304')
+            return 304, headers, b''
+        headers['Content-Type'] = feed.content_type
+        SUBSCRIPTION_REQUESTS.inc(feed=name, status='200')
+        if 'gzip' in request.headers.get('accept-encoding', ''):
+            headers['Content-Encoding'] = 'gzip'
+            return 200, headers, feed.gzipped
+        return 200, headers, feed.body
+
+
+SUBSCRIPTIONS = SubscriptionFeeds(SUBSCRIPTION_PATH)
+
+
+def make_webhook_handler(application: Application, path: str, secret_token: str):
+    async def handle(request: HttpRequest):
+        if request.path != path:
+            return 404, {}, b''
+        if request.method != 'POST':
+            return 405, {'Allow': 'POST'}, b''
+        received = request.headers.get('x-telegram-bot-api-secret-token', '')
+        if secret_token and not hmac.compare_digest(received, secret_token):
+            return 403, {}, b''
+        try:
+            payload = json.loads(request.body)
+            # de_json expects an object: lists fail inside it, and {} comes back as None.
+            update = Update.de_json(payload, application.bot) if isinstance(payload, dict) else None
+        except (ValueError, TypeError, KeyError):
+            return 400, {}, b''
+        if update is None:
+            return 400, {}, b''
+        await application.update_queue.put(update)
+        return 200, {}, b''
+
+    return handle
+
+
+async def run_webhook(application: Application, args) -> None:
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    # run_polling invokes these hooks itself; with a manual lifecycle we have to.
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    handler = make_webhook_handler(application, args.webhook_path, args.secret_token)
+    # With several workers each one binds the same port and the kernel spreads connections.
+    server = await serve_http(args.listen, args.port, handler, args.max_connections, reuse_port=args.workers > 1)
+    if WORKER_INDEX == 0:
+        await application.bot.set_webhook(
+            url=args.webhook_url,
+            secret_token=args.secret_token,
+            max_connections=args.max_connections,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    logger.info("Webhook server listening on %s:%s%s", args.listen, args.port, args.webhook_path)
+    try:
+        await stop_event.wait()
+    finally:
+        await server.close()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def build_application(args) -> Application:
+    builder = (
+        Application.builder()
+        .token(args.token)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    timeouts = dict(
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        write_timeout=args.write_timeout,
+        pool_timeout=args.pool_timeout,
+    )
+    builder = builder.request(InstrumentedRequest(
+        connection_pool_size=args.api_pool_size, http_version='2' if args.http2 else '1.1', **timeouts
+    ))
+    # One long-lived connection; HTTP/2 buys nothing for a single request at a time.
+    builder = builder.get_updates_request(InstrumentedRequest(connection_pool_size=1, **timeouts))
+    builder = builder.concurrent_updates(args.concurrent_updates)
+    if args.base_url:
+        builder = builder.base_url(args.base_url)
+    application = builder.build()
+
+    application.add_handler(TypeHandler(Update, track_activity), group=-2)
+    application.add_handler(TypeHandler(Update, flood_guard), group=-1)
+    application.add_handler(CommandHandler("start", instrumented('start', start)))
+    application.add_handler(CommandHandler("admin", instrumented('admin', admin)))
     application.add_handler(CallbackQueryHandler(button_handler))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    application.add_handler(InlineQueryHandler(instrumented('inline', inline_search)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented('text', handle_text)))
+    application.add_handler(MessageHandler(filters.Document.ALL, instrumented('document', handle_document)))
+    return application
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Azadi-Net Telegram bot")
+    parser.add_argument('--token', default=TOKEN)
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default=BOT_MODE)
+    parser.add_argument('--base-url', default=TELEGRAM_BASE_URL,
+                        help="Bot API base URL, e.g. a local Bot API server or a test double")
+    parser.add_argument('--webhook-url', default=WEBHOOK_URL, help="Public URL Telegram should POST updates to")
+    parser.add_argument('--listen', default=WEBHOOK_LISTEN)
+    parser.add_argument('--port', type=int, default=WEBHOOK_PORT)
+    parser.add_argument('--webhook-path', default=WEBHOOK_PATH)
+    parser.add_argument('--secret-token', default=WEBHOOK_SECRET)
+    parser.add_argument('--max-connections', type=int, default=WEBHOOK_MAX_CONNECTIONS)
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help="Worker processes sharing the webhook port (webhook mode only)")
+    parser.add_argument('--api-pool-size', type=int, default=API_POOL_SIZE,
+                        help="Connections kept open to the Bot API for regular calls")
+    parser.add_argument('--http2', action='store_true', default=API_HTTP2,
+                        help="Multiplex Bot API calls over HTTP/2 (needs the 'h2' package)")
+    parser.add_argument('--connect-timeout', type=float, default=API_CONNECT_TIMEOUT)
+    parser.add_argument('--read-timeout', type=float, default=API_READ_TIMEOUT)
+    parser.add_argument('--write-timeout', type=float, default=API_WRITE_TIMEOUT)
+    parser.add_argument('--pool-timeout', type=float, default=API_POOL_TIMEOUT,
+                        help="Seconds a call may wait for a free pooled connection")
+    parser.add_argument('--concurrent-updates', type=int, default=CONCURRENT_UPDATES,
+                        help="Updates processed at the same time per process (1 = sequential)")
+    args = parser.parse_args(argv)
+    if args.api_pool_size < 1 or args.concurrent_updates < 1:
+        parser.error("--api-pool-size and --concurrent-updates must be at least 1")
+    if args.http2 and importlib.util.find_spec('h2') is None:
+        parser.error("--http2 (or API_HTTP2=1) requires the 'h2' package: pip install 'httpx[http2]'")
+    if args.mode == 'webhook':
+        if not args.webhook_url:
+            parser.error("--webhook-url (or WEBHOOK_URL) is required in webhook mode")
+        if not args.secret_token:
+            args.secret_token = secrets.token_urlsafe(32)
+    if args.workers > 1:
+        if args.mode != 'webhook':
+            parser.error("--workers > 1 requires webhook mode")
+        if not STATE.shared or STORAGE_BACKEND != 'sqlite':
+            parser.error("--workers > 1 requires STATE_BACKEND=redis and STORAGE_BACKEND=sqlite")
+    return args
+
+
+def worker_main(args, index: int) -> None:
+    global WORKER_INDEX, WORKERS
+    WORKER_INDEX = index
+    WORKERS = args.workers
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s [w{index}] %(name)s %(levelname)s %(message)s')
+    asyncio.run(run_webhook(build_application(args), args))
+
+
+def run_workers(args) -> None:
+    # spawn, not fork: every worker must open its own storage and state connections.
+    ctx = multiprocessing.get_context('spawn')
+    workers = [ctx.Process(target=worker_main, args=(args, i), name=f'azadi-worker-{i}') for i in range(args.workers)]
+    for process in workers:
+        process.start()
+
+    def forward(signum, frame):
+        for process in workers:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for process in workers:
+        process.join()
+
+
+def main(argv=None) -> None:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    args = parse_args(argv)
 
     print("🤖 ربات آزادی‌نت فعال شد...")
-    application.run_polling()
+    if args.workers > 1:
+        run_workers(args)
+    elif args.mode == 'webhook':
+        asyncio.run(run_webhook(build_application(args), args))
+    else:
+        build_application(args).run_polling()
 
 
 if __name__ == '__main__':
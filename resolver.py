@@ -0,0 +1,105 @@
+import time
+import socket
+import asyncio
+import ipaddress
+from collections import Counter
+
+try:
+    import aiodns
+except ImportError:
+    aiodns = None
+
+DEFAULT_TTL = 300.0
+NEGATIVE_TTL = 30.0
+MIN_TTL = 5.0
+MAX_TTL = 3600.0
+
+# UnicodeError: getaddrinfo's IDNA encoding rejects names like 'a..example.com'.
+LOOKUP_ERRORS = (OSError, UnicodeError, asyncio.TimeoutError) + ((aiodns.error.DNSError,) if aiodns else ())
+
+
+class ResolveError(OSError):
+    pass
+
+
+class DnsResolver:
+    """Async hostname lookups behind a TTL cache.
+
+    With aiodns installed, queries go through c-ares and are cached for the
+    record's own TTL. Without it, the loop's getaddrinfo is used and results
+    are kept for ``default_ttl``. Failures are cached for ``negative_ttl``.
+    Concurrent lookups of the same host share one query.
+    """
+
+    def __init__(self, default_ttl: float = DEFAULT_TTL, negative_ttl: float = NEGATIVE_TTL, timeout: float = 5.0):
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self.lookups = Counter()
+        self._cache = {}
+        self._inflight = {}
+        self._channel = None
+
+    @property
+    def backend(self) -> str:
+        return 'aiodns' if aiodns is not None else 'getaddrinfo'
+
+    async def resolve(self, host: str) -> list:
+        try:
+            ipaddress.ip_address(host)
+            return [host]
+        except ValueError:
+            pass
+        cached = self._cache.get(host)
+        if cached is not None and cached[0] > time.monotonic():
+            if cached[1] is None:
+                self.lookups['negative'] += 1
+                raise ResolveError(f"{host}: lookup failed recently")
+            self.lookups['hit'] += 1
+            return cached[1]
+        task = self._inflight.get(host)
+        if task is None:
+            self.lookups['miss'] += 1
+            task = self._inflight[host] = asyncio.ensure_future(self._lookup(host))
+            task.add_done_callback(lambda done: self._lookup_done(host, done))
+        else:
+            self.lookups['shared'] += 1
+        # Shielded so one caller giving up does not cancel the query for the others.
+        return await asyncio.shield(task)
+
+    def _lookup_done(self, host: str, task: asyncio.Future) -> None:
+        self._inflight.pop(host, None)
+        # Every caller may have given up already; retrieve the failure so asyncio
+        # does not report it as never retrieved.
+        if not task.cancelled():
+            task.exception()
+
+    async def _lookup(self, host: str) -> list:
+        try:
+            addresses, ttl = await asyncio.wait_for(self._query(host), self.timeout)
+        except LOOKUP_ERRORS as exc:
+            self.lookups['failure'] += 1
+            self._cache[host] = (time.monotonic() + self.negative_ttl, None)
+            raise ResolveError(f"{host}: {exc}") from exc
+        self._cache[host] = (time.monotonic() + min(max(ttl, MIN_TTL), MAX_TTL), addresses)
+        return addresses
+
+    async def _query(self, host: str) -> tuple:
+        if aiodns is not None:
+            if self._channel is None:
+                self._channel = aiodns.DNSResolver()
+            for qtype in ('A', 'AAAA'):
+                try:
+                    records = await self._channel.query(host, qtype)
+                except aiodns.error.DNSError:
+                    continue
+                if records:
+                    return [record.host for record in records], min(record.ttl for record in records)
+        # c-ares skips /etc/hosts and search domains; the system resolver covers those.
+        infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        return list(dict.fromkeys(info[4][0] for info in infos)), self.default_ttl
+
+    def prune(self, hosts) -> None:
+        # Drop hosts no config points at any more.
+        for host in [host for host in self._cache if host not in hosts]:
+            del self._cache[host]
@@ -0,0 +1,237 @@
+import json
+import base64
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlparse
+
+TLS_BY_DEFAULT = ('trojan', 'hysteria2', 'hysteria', 'tuic')
+SCHEME_ALIASES = {'hy2': 'hysteria2'}
+DEFAULT_PORT = 443
+
+
+def b64decode(data: str) -> str:
+    data = data.strip().replace('-', '+').replace('_', '/')
+    return base64.b64decode(data + '=' * (-len(data) % 4)).decode('utf-8')
+
+
+def b64encode(text: str, urlsafe: bool = False) -> str:
+    if urlsafe:
+        return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii').rstrip('=')
+    return base64.b64encode(text.encode('utf-8')).decode('ascii')
+
+
+def country_from_name(name: str):
+    # A flag emoji is two regional indicator symbols, one per letter of the ISO code.
+    letters = []
+    for ch in name or '':
+        if 0x1F1E6 <= ord(ch) <= 0x1F1FF:
+            letters.append(chr(ord(ch) - 0x1F1E6 + ord('A')))
+            if len(letters) == 2:
+                return ''.join(letters)
+        else:
+            letters.clear()
+    return None
+
+
+def country_flag(code: str) -> str:
+    return ''.join(chr(0x1F1E6 + ord(letter) - ord('A')) for letter in code)
+
+
+class ParsedConfig:
+    """Everything probing, menus and feeds need from one share link, parsed once."""
+
+    __slots__ = (
+        'protocol', 'host', 'port', 'transport', 'tls', 'sni', 'country', 'link_name',
+        'uuid', 'password', 'cipher', 'alter_id', 'flow', 'path', 'ws_host', 'service_name',
+        'insecure', 'fingerprint', 'reality', 'public_key', 'short_id', 'obfs', 'obfs_password', 'alpn',
+    )
+
+    def __init__(self, protocol: str, host: str = None, port: int = None):
+        self.protocol = protocol
+        self.host = host
+        self.port = port
+        self.transport = 'tcp'
+        self.tls = False
+        self.sni = ''
+        self.country = None
+        self.link_name = ''
+        self.uuid = ''
+        self.password = ''
+        self.cipher = ''
+        self.alter_id = 0
+        self.flow = ''
+        self.path = ''
+        self.ws_host = ''
+        self.service_name = ''
+        self.insecure = False
+        self.fingerprint = ''
+        self.reality = False
+        self.public_key = ''
+        self.short_id = ''
+        self.obfs = ''
+        self.obfs_password = ''
+        self.alpn = ''
+
+    @property
+    def known(self) -> bool:
+        return self.host is not None
+
+
+def _parse_vmess(url: str) -> ParsedConfig:
+    data = json.loads(b64decode(url.split('://', 1)[1].split('#', 1)[0]))
+    record = ParsedConfig('vmess', data['add'], int(data['port']))
+    record.uuid = data['id']
+    record.alter_id = int(data.get('aid') or 0)
+    record.cipher = data.get('scy') or 'auto'
+    record.transport = data.get('net') or 'tcp'
+    record.path = data.get('path', '')
+    record.ws_host = data.get('host', '')
+    record.service_name = data.get('path', '')
+    record.tls = data.get('tls') == 'tls'
+    record.sni = data.get('sni') or data.get('host', '')
+    record.fingerprint = data.get('fp', '')
+    record.link_name = data.get('ps', '')
+    return record
+
+
+def _split_host_port(hostport: str) -> tuple:
+    host, _, port = hostport.rpartition(':')
+    if not host:
+        raise ValueError("share link has no host")
+    return host.strip('[]'), int(port)
+
+
+def _parse_ss(url: str) -> ParsedConfig:
+    rest, _, fragment = url.split('://', 1)[1].partition('#')
+    if '@' not in rest:
+        # Legacy form: the whole method:password@host:port is base64, and the
+        # password may contain anything, so split on the last '@' and ':'.
+        userinfo, _, hostport = b64decode(rest.split('?', 1)[0]).rpartition('@')
+    else:
+        # SIP002: userinfo is either base64 or percent-encoded method:password.
+        userinfo, _, hostport = rest.rpartition('@')
+        hostport = hostport.split('/', 1)[0].split('?', 1)[0]
+        userinfo = unquote(userinfo)
+        if ':' not in userinfo:
+            userinfo = b64decode(userinfo)
+    method, _, password = userinfo.partition(':')
+    host, port = _split_host_port(hostport)
+    record = ParsedConfig('ss', host, port)
+    record.cipher = method
+    record.password = password
+    record.link_name = unquote(fragment)
+    return record
+
+
+def _parse_ssr(url: str) -> ParsedConfig:
+    # ssr://base64(host:port:protocol:method:obfs:base64(password)/?params), where the
+    # params are base64 too; some generators still append a #fragment after it.
+    main, _, query = b64decode(url.split('://', 1)[1].split('#', 1)[0]).partition('/?')
+    host, port, _, method, obfs, password = main.rsplit(':', 5)
+    record = ParsedConfig('ssr', host.strip('[]'), int(port))
+    record.cipher = method
+    record.obfs = obfs
+    record.password = b64decode(password)
+    params = {key: values[0] for key, values in parse_qs(query).items()}
+    if params.get('remarks'):
+        record.link_name = b64decode(params['remarks'])
+    return record
+
+
+def _parse_standard(url: str) -> ParsedConfig:
+    scheme = url.split('://', 1)[0].lower()
+    protocol = SCHEME_ALIASES.get(scheme, scheme)
+    parsed = urlparse(url)
+    params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+    if not parsed.hostname:
+        raise ValueError("share link has no host")
+    record = ParsedConfig(protocol, parsed.hostname, parsed.port or DEFAULT_PORT)
+    security = params.get('security', 'tls' if protocol in TLS_BY_DEFAULT else 'none')
+    record.transport = params.get('type', 'tcp')
+    record.path = params.get('path', '')
+    record.ws_host = params.get('host', '')
+    record.service_name = params.get('serviceName', '')
+    record.tls = security in ('tls', 'reality', 'xtls')
+    record.sni = params.get('sni') or params.get('peer') or params.get('host', '')
+    record.insecure = params.get('allowInsecure', params.get('insecure')) == '1'
+    record.fingerprint = params.get('fp', '')
+    record.flow = params.get('flow', '')
+    record.reality = security == 'reality'
+    record.public_key = params.get('pbk', '')
+    record.short_id = params.get('sid', '')
+    record.obfs = params.get('obfs', '')
+    record.obfs_password = params.get('obfs-password', params.get('obfsParam', ''))
+    record.alpn = params.get('alpn', '')
+    record.link_name = unquote(parsed.fragment)
+    userinfo = parsed.netloc.rpartition('@')[0]
+    if protocol == 'vless':
+        record.uuid = unquote(userinfo)
+    elif protocol == 'tuic':
+        uuid, _, password = unquote(userinfo).partition(':')
+        record.uuid, record.password = uuid, password
+    else:
+        record.password = unquote(userinfo)
+    return record
+
+
+PARSERS = {
+    'vmess': _parse_vmess,
+    'ss': _parse_ss,
+    'ssr': _parse_ssr,
+    'vless': _parse_standard,
+    'trojan': _parse_standard,
+    'hy2': _parse_standard,
+    'hysteria2': _parse_standard,
+    'hysteria': _parse_standard,
+    'tuic': _parse_standard,
+}
+
+
+def with_link_name(url: str, name: str) -> str:
+    """Return ``url`` renamed to ``name`` the way clients of its scheme read names back."""
+    scheme, _, rest = url.partition('://')
+    try:
+        if scheme.lower() == 'vmess':
+            # The whole body is base64 JSON, so a #fragment would break decoding.
+            data = json.loads(b64decode(rest.split('#', 1)[0]))
+            data['ps'] = name
+            return f"{scheme}://{b64encode(json.dumps(data, ensure_ascii=False))}"
+        if scheme.lower() == 'ssr':
+            main, _, query = b64decode(rest.split('#', 1)[0]).partition('/?')
+            params = {key: values[0] for key, values in parse_qs(query, keep_blank_values=True).items()}
+            params['remarks'] = b64encode(name, urlsafe=True)
+            return f"{scheme}://{b64encode(main + '/?' + urlencode(params), urlsafe=True)}"
+    except (ValueError, TypeError, AttributeError):
+        return url
+    return f"{url.split('#', 1)[0]}#{quote(name)}"
+
+
+def parse_config_url(url: str, name: str = '') -> ParsedConfig:
+    """Parse a share link; unknown schemes and malformed links come back with ``host`` None."""
+    scheme = url.split('://', 1)[0].lower()
+    parser = PARSERS.get(scheme)
+    try:
+        record = parser(url.strip()) if parser else ParsedConfig(scheme)
+    except (ValueError, KeyError, TypeError, AttributeError, UnicodeDecodeError):
+        record = ParsedConfig(SCHEME_ALIASES.get(scheme, scheme))
+    record.country = country_from_name(name) or country_from_name(record.link_name)
+    return record
+
+
+class ConfigIndex:
+    """Parsed records per config id, reparsed only when an entry's URL or name changes."""
+
+    def __init__(self):
+        self._records = {}
+
+    def get(self, cfg_id: str, cfg: dict) -> ParsedConfig:
+        cached = self._records.get(cfg_id)
+        if cached is not None and cached[0] == cfg['config'] and cached[1] == cfg['name']:
+            return cached[2]
+        record = parse_config_url(cfg['config'], cfg['name'])
+        self._records[cfg_id] = (cfg['config'], cfg['name'], record)
+        return record
+
+    def sync(self, configs: dict) -> None:
+        for cfg_id in [cfg_id for cfg_id in self._records if cfg_id not in configs]:
+            del self._records[cfg_id]
+        for cfg_id, cfg in configs.items():
+            self.get(cfg_id, cfg)
@@ -0,0 +1,187 @@
+import json
+from abc import ABC, abstractmethod
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+CONVERSATION_TTL = 3600
+
+
+class SharedState(ABC):
+    """Hot state that every bot worker must agree on.
+
+    Durable data still lives in storage; this layer holds the user-id set
+    used for membership checks, counters, per-user conversation state and
+    small shared blobs such as health snapshots.
+    """
+
+    shared = True
+
+    @abstractmethod
+    async def add_user(self, user_id: int) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def add_users(self, user_ids) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def remove_user(self, user_id: int) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def has_user(self, user_id: int) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def user_count(self) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def incr(self, name: str, amount: int = 1) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_counter(self, name: str) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_conversation(self, user_id: int) -> dict:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_conversation(self, user_id: int, data: dict) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def clear_conversation(self, user_id: int) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_blob(self, name: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_blob(self, name: str, value) -> None:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class LocalState(SharedState):
+    """Single-process backend; what the bot always did, behind the shared interface."""
+
+    shared = False
+
+    def __init__(self):
+        self._users = set()
+        self._counters = {}
+        self._conversations = {}
+        self._blobs = {}
+
+    async def add_user(self, user_id: int) -> bool:
+        if user_id in self._users:
+            return False
+        self._users.add(user_id)
+        return True
+
+    async def add_users(self, user_ids) -> None:
+        self._users.update(user_ids)
+
+    async def remove_user(self, user_id: int) -> None:
+        self._users.discard(user_id)
+
+    async def has_user(self, user_id: int) -> bool:
+        return user_id in self._users
+
+    async def user_count(self) -> int:
+        return len(self._users)
+
+    async def incr(self, name: str, amount: int = 1) -> int:
+        self._counters[name] = self._counters.get(name, 0) + amount
+        return self._counters[name]
+
+    async def get_counter(self, name: str) -> int:
+        return self._counters.get(name, 0)
+
+    async def get_conversation(self, user_id: int) -> dict:
+        return dict(self._conversations.get(user_id, {}))
+
+    async def set_conversation(self, user_id: int, data: dict) -> None:
+        self._conversations[user_id] = dict(data)
+
+    async def clear_conversation(self, user_id: int) -> None:
+        self._conversations.pop(user_id, None)
+
+    async def get_blob(self, name: str):
+        return self._blobs.get(name)
+
+    async def set_blob(self, name: str, value) -> None:
+        self._blobs[name] = value
+
+
+class RedisState(SharedState):
+    """Backend for any server speaking the Redis protocol (Redis, KeyDB, Valkey, a test double)."""
+
+    def __init__(self, url: str, prefix: str = 'azadi:'):
+        if aioredis is None:
+            raise RuntimeError("STATE_BACKEND=redis requires the 'redis' package")
+        self._redis = aioredis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    def _key(self, *parts) -> str:
+        return self.prefix + ':'.join(str(p) for p in parts)
+
+    async def add_user(self, user_id: int) -> bool:
+        return bool(await self._redis.sadd(self._key('users'), user_id))
+
+    async def add_users(self, user_ids) -> None:
+        user_ids = list(user_ids)
+        for i in range(0, len(user_ids), 10000):
+            await self._redis.sadd(self._key('users'), *user_ids[i:i + 10000])
+
+    async def remove_user(self, user_id: int) -> None:
+        await self._redis.srem(self._key('users'), user_id)
+
+    async def has_user(self, user_id: int) -> bool:
+        return bool(await self._redis.sismember(self._key('users'), user_id))
+
+    async def user_count(self) -> int:
+        return await self._redis.scard(self._key('users'))
+
+    async def incr(self, name: str, amount: int = 1) -> int:
+        return await self._redis.incrby(self._key('counter', name), amount)
+
+    async def get_counter(self, name: str) -> int:
+        return int(await self._redis.get(self._key('counter', name)) or 0)
+
+    async def get_conversation(self, user_id: int) -> dict:
+        raw = await self._redis.get(self._key('conv', user_id))
+        return json.loads(raw) if raw else {}
+
+    async def set_conversation(self, user_id: int, data: dict) -> None:
+        await self._redis.set(self._key('conv', user_id), json.dumps(data, ensure_ascii=False), ex=CONVERSATION_TTL)
+
+    async def clear_conversation(self, user_id: int) -> None:
+        await self._redis.delete(self._key('conv', user_id))
+
+    async def get_blob(self, name: str):
+        raw = await self._redis.get(self._key('blob', name))
+        return json.loads(raw) if raw else None
+
+    async def set_blob(self, name: str, value) -> None:
+        await self._redis.set(self._key('blob', name), json.dumps(value, ensure_ascii=False))
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+
+def open_state(backend: str, url: str = '') -> SharedState:
+    if backend == 'local':
+        return LocalState()
+    if backend == 'redis':
+        return RedisState(url or 'redis://127.0.0.1:6379/0')
+    raise ValueError(f"Unknown state backend: {backend}")
@@ -0,0 +1,504 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_COMPACT_EVERY = 5000
+
+
+def load_json_file(file_path: str, default_value):
+    try:
+        if not os.path.exists(file_path):
+            save_json_file(file_path, default_value)
+            return json.loads(json.dumps(default_value))
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception:
+        # Keep the unreadable file around instead of letting the next save overwrite it.
+        if os.path.exists(file_path):
+            backup = f"{file_path}.corrupt-{int(time.time())}"
+            try:
+                os.replace(file_path, backup)
+                logger.error("Could not parse %s, moved it to %s", file_path, backup)
+            except OSError:
+                logger.exception("Could not parse %s", file_path)
+        return json.loads(json.dumps(default_value))
+
+
+def save_json_file(file_path: str, data) -> None:
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
+def _read_users_file(file_path: str) -> set:
+    users = load_json_file(file_path, [])
+    if isinstance(users, dict):
+        users = list(users.values())
+    return set(int(u) for u in users)
+
+
+def _activity_record(activity: dict, user_id: int) -> list:
+    # [registered_at, last_seen, language]; older files stored only the first two.
+    record = activity.setdefault(user_id, [None, None, None])
+    if len(record) < 3:
+        record.extend([None] * (3 - len(record)))
+    return record
+
+
+def _apply_seen(activity: dict, user_id: int, seen) -> None:
+    ts, language = seen if isinstance(seen, (list, tuple)) else (seen, None)
+    record = _activity_record(activity, user_id)
+    record[1] = ts
+    if language:
+        record[2] = language
+
+
+def _iter_activity(users, activity: dict, batch_size: int):
+    ordered = sorted(users)
+    for i in range(0, len(ordered), batch_size):
+        yield [(u, *(list(activity.get(u) or ()) + [None, None, None])[:3]) for u in ordered[i:i + batch_size]]
+
+
+class Storage(ABC):
+    """Persistence backend for the user set and the config table.
+
+    Writes are expressed as deltas so backends that support it only pay for
+    what changed; reads happen once at startup, except for exports, which
+    stream users in id order through ``iter_users``.
+    """
+
+    @abstractmethod
+    def load_users(self) -> set:
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_users(self, user_ids) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_users(self, user_ids) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def touch_users(self, seen: dict) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_users(self, batch_size: int = 10000):
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_configs(self) -> dict:
+        raise NotImplementedError
+
+    @abstractmethod
+    def put_config(self, cfg_id: str, cfg: dict) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def put_configs(self, configs: dict) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_config(self, cfg_id: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_meta(self, key: str, default=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_meta(self, key: str, value) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class JsonStorage(Storage):
+    """The original users.json / configs.json layout, rewritten on every change.
+
+    Last-seen updates are the exception: they are appended to a small log and
+    folded into users_activity.json when that is rewritten anyway, so active
+    users do not cause a full rewrite on every flush.
+    """
+
+    def __init__(self, users_file: str, configs_file: str, default_configs: dict):
+        self.users_file = users_file
+        self.configs_file = configs_file
+        self.meta_file = os.path.join(os.path.dirname(configs_file), 'meta.json')
+        self.activity_file = os.path.join(os.path.dirname(configs_file), 'users_activity.json')
+        self._users = _read_users_file(users_file)
+        self._configs = load_json_file(configs_file, default_configs)
+        self._meta = load_json_file(self.meta_file, {})
+        # {user_id: [registered_at, last_seen, language]}; users.json itself stays a plain id list.
+        self._activity = {int(u): v for u, v in load_json_file(self.activity_file, {}).items()}
+        self.seen_file = f"{self.activity_file}.seen"
+        self._seen_entries = 0
+        self._lock = threading.Lock()
+        if os.path.exists(self.seen_file):
+            self._replay_seen()
+            self._save_activity()
+
+    def _replay_seen(self) -> None:
+        with open(self.seen_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    seen = json.loads(line)
+                except ValueError:
+                    # A torn last line; the log is folded and truncated right after.
+                    continue
+                for u, value in seen.items():
+                    if int(u) in self._users:
+                        _apply_seen(self._activity, int(u), value)
+
+    def _save_activity(self) -> None:
+        save_json_file(self.activity_file, {str(u): v for u, v in self._activity.items()})
+        # Everything logged so far is in the file now.
+        with open(self.seen_file, 'w', encoding='utf-8'):
+            pass
+        self._seen_entries = 0
+
+    def load_users(self) -> set:
+        return set(self._users)
+
+    def add_users(self, user_ids) -> None:
+        now = int(time.time())
+        with self._lock:
+            for u in user_ids:
+                u = int(u)
+                if u not in self._users:
+                    self._users.add(u)
+                    self._activity[u] = [now, None, None]
+            save_json_file(self.users_file, sorted(self._users))
+            self._save_activity()
+
+    def remove_users(self, user_ids) -> None:
+        with self._lock:
+            for u in user_ids:
+                self._users.discard(int(u))
+                self._activity.pop(int(u), None)
+            save_json_file(self.users_file, sorted(self._users))
+            self._save_activity()
+
+    def touch_users(self, seen: dict) -> None:
+        with self._lock:
+            seen = {str(u): list(value) for u, value in seen.items() if int(u) in self._users}
+            if not seen:
+                return
+            for u, value in seen.items():
+                _apply_seen(self._activity, int(u), value)
+            if self._seen_entries >= JOURNAL_COMPACT_EVERY:
+                self._save_activity()
+                return
+            with open(self.seen_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(seen) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._seen_entries += 1
+
+    def iter_users(self, batch_size: int = 10000):
+        with self._lock:
+            users = set(self._users)
+            activity = dict(self._activity)
+        yield from _iter_activity(users, activity, batch_size)
+
+    def load_configs(self) -> dict:
+        return dict(self._configs)
+
+    def put_config(self, cfg_id: str, cfg: dict) -> None:
+        self.put_configs({cfg_id: cfg})
+
+    def put_configs(self, configs: dict) -> None:
+        with self._lock:
+            self._configs.update(configs)
+            save_json_file(self.configs_file, self._configs)
+
+    def delete_config(self, cfg_id: str) -> None:
+        with self._lock:
+            self._configs.pop(cfg_id, None)
+            save_json_file(self.configs_file, self._configs)
+
+    def get_meta(self, key: str, default=None):
+        return self._meta.get(key, default)
+
+    def set_meta(self, key: str, value) -> None:
+        with self._lock:
+            self._meta[key] = value
+            save_json_file(self.meta_file, self._meta)
+
+
+class JournalStorage(Storage):
+    """Append-only JSON-lines journal replayed over a periodically compacted snapshot.
+
+    A crash can at worst leave a torn final line, which is cut off on replay.
+    """
+
+    def __init__(self, path: str, compact_every: int = JOURNAL_COMPACT_EVERY):
+        self.path = path
+        self.snapshot_path = f"{path}.snapshot"
+        self.compact_every = compact_every
+        self._users = set()
+        self._activity = {}
+        self._configs = {}
+        self._meta = {}
+        self._entries = 0
+        self._lock = threading.Lock()
+        self._replay()
+        self._fh = open(self.path, 'a', encoding='utf-8')
+
+    def _replay(self) -> None:
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            self._users = set(snapshot.get('users', []))
+            self._activity = {int(u): v for u, v in snapshot.get('activity', {}).items()}
+            self._configs = snapshot.get('configs', {})
+            self._meta = snapshot.get('meta', {})
+        if not os.path.exists(self.path):
+            return
+        end, tail, parsed = 0, b'\n', True
+        with open(self.path, 'rb') as f:
+            for tail in f:
+                try:
+                    entry = json.loads(tail)
+                except ValueError:
+                    logger.warning("Skipping torn journal entry in %s", self.path)
+                    parsed = False
+                else:
+                    self._apply(entry)
+                    self._entries += 1
+                    parsed = True
+                if parsed or tail.endswith(b'\n'):
+                    end += len(tail)
+        if not tail.endswith(b'\n'):
+            # The next append would be glued onto an unterminated line and lost with it:
+            # cut a torn entry off, or end a whole one that only lost its newline.
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+                if parsed:
+                    f.seek(end)
+                    f.write(b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _apply(self, entry: dict) -> None:
+        op = entry.get('op')
+        if op == 'users+':
+            for u in entry['ids']:
+                if u not in self._users:
+                    self._users.add(u)
+                    self._activity[u] = [entry.get('at'), None, None]
+        elif op == 'users-':
+            self._users.difference_update(entry['ids'])
+            for u in entry['ids']:
+                self._activity.pop(u, None)
+        elif op == 'seen':
+            for u, value in entry['ids'].items():
+                if int(u) in self._users:
+                    _apply_seen(self._activity, int(u), value)
+        elif op == 'cfg':
+            self._configs[entry['id']] = entry['value']
+        elif op == 'cfgs':
+            self._configs.update(entry['values'])
+        elif op == 'cfg-':
+            self._configs.pop(entry['id'], None)
+        elif op == 'meta':
+            self._meta[entry['key']] = entry['value']
+
+    def _append(self, entry: dict) -> None:
+        with self._lock:
+            self._apply(entry)
+            self._fh.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self._entries += 1
+            if self._entries >= self.compact_every:
+                self._compact()
+
+    def _compact(self) -> None:
+        snapshot = {
+            'users': sorted(self._users),
+            'activity': {str(u): v for u, v in self._activity.items()},
+            'configs': self._configs,
+            'meta': self._meta,
+        }
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self._fh.close()
+        self._fh = open(self.path, 'w', encoding='utf-8')
+        self._entries = 0
+
+    def load_users(self) -> set:
+        return set(self._users)
+
+    def add_users(self, user_ids) -> None:
+        self._append({'op': 'users+', 'ids': [int(u) for u in user_ids], 'at': int(time.time())})
+
+    def remove_users(self, user_ids) -> None:
+        self._append({'op': 'users-', 'ids': [int(u) for u in user_ids]})
+
+    def touch_users(self, seen: dict) -> None:
+        self._append({'op': 'seen', 'ids': {str(u): list(value) for u, value in seen.items()}})
+
+    def iter_users(self, batch_size: int = 10000):
+        with self._lock:
+            users = set(self._users)
+            activity = dict(self._activity)
+        yield from _iter_activity(users, activity, batch_size)
+
+    def load_configs(self) -> dict:
+        return dict(self._configs)
+
+    def put_config(self, cfg_id: str, cfg: dict) -> None:
+        self._append({'op': 'cfg', 'id': cfg_id, 'value': cfg})
+
+    def put_configs(self, configs: dict) -> None:
+        self._append({'op': 'cfgs', 'values': configs})
+
+    def delete_config(self, cfg_id: str) -> None:
+        self._append({'op': 'cfg-', 'id': cfg_id})
+
+    def get_meta(self, key: str, default=None):
+        return self._meta.get(key, default)
+
+    def set_meta(self, key: str, value) -> None:
+        self._append({'op': 'meta', 'key': key, 'value': value})
+
+    def close(self) -> None:
+        with self._lock:
+            self._compact()
+            self._fh.close()
+
+
+class SqliteStorage(Storage):
+    """SQLite in WAL mode; each change is a single-row transaction."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS users "
+            "(user_id INTEGER PRIMARY KEY, registered_at INTEGER, last_seen INTEGER, language TEXT)"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(users)")}
+        for column, kind in (('registered_at', 'INTEGER'), ('last_seen', 'INTEGER'), ('language', 'TEXT')):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE users ADD COLUMN {column} {kind}")
+        self._db.execute("CREATE TABLE IF NOT EXISTS configs (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def _write(self, sql: str, rows) -> None:
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(sql, rows)
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def load_users(self) -> set:
+        with self._lock:
+            return set(row[0] for row in self._db.execute("SELECT user_id FROM users"))
+
+    def add_users(self, user_ids) -> None:
+        now = int(time.time())
+        self._write("INSERT OR IGNORE INTO users (user_id, registered_at) VALUES (?, ?)", [(int(u), now) for u in user_ids])
+
+    def remove_users(self, user_ids) -> None:
+        self._write("DELETE FROM users WHERE user_id = ?", [(int(u),) for u in user_ids])
+
+    def touch_users(self, seen: dict) -> None:
+        self._write(
+            "UPDATE users SET last_seen = ?, language = COALESCE(?, language) WHERE user_id = ?",
+            [(ts, language, int(u)) for u, (ts, language) in seen.items()],
+        )
+
+    def iter_users(self, batch_size: int = 10000):
+        # Keyset pagination: the lock is held per batch, never for the whole export.
+        last = -(2 ** 63)
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT user_id, registered_at, last_seen, language FROM users WHERE user_id > ? "
+                    "ORDER BY user_id LIMIT ?",
+                    (last, batch_size),
+                ).fetchall()
+            if not rows:
+                return
+            yield rows
+            last = rows[-1][0]
+
+    def load_configs(self) -> dict:
+        with self._lock:
+            rows = self._db.execute("SELECT id, data FROM configs ORDER BY rowid").fetchall()
+        return {cfg_id: json.loads(data) for cfg_id, data in rows}
+
+    def put_config(self, cfg_id: str, cfg: dict) -> None:
+        self.put_configs({cfg_id: cfg})
+
+    def put_configs(self, configs: dict) -> None:
+        # Upsert keeps the original rowid so menus stay in insertion order.
+        self._write(
+            "INSERT INTO configs (id, data) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+            [(cfg_id, json.dumps(cfg, ensure_ascii=False)) for cfg_id, cfg in configs.items()],
+        )
+
+    def delete_config(self, cfg_id: str) -> None:
+        self._write("DELETE FROM configs WHERE id = ?", [(cfg_id,)])
+
+    def get_meta(self, key: str, default=None):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key: str, value) -> None:
+        self._write(
+            "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            [(key, json.dumps(value))],
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def migrate_from_json(storage: Storage, users_file: str, configs_file: str, default_configs: dict) -> None:
+    if isinstance(storage, JsonStorage) or storage.get_meta('migrated'):
+        return
+    if os.path.exists(users_file):
+        storage.add_users(_read_users_file(users_file))
+    configs = load_json_file(configs_file, default_configs) if os.path.exists(configs_file) else default_configs
+    storage.put_configs(configs)
+    storage.set_meta('migrated', int(time.time()))
+    logger.info("Migrated users and configs from JSON into %s", type(storage).__name__)
+
+
+def open_storage(backend: str, path: str, users_file: str, configs_file: str, default_configs: dict) -> Storage:
+    if backend == 'json':
+        return JsonStorage(users_file, configs_file, default_configs)
+    if backend == 'journal':
+        storage = JournalStorage(path or 'azadi.journal')
+    elif backend == 'sqlite':
+        storage = SqliteStorage(path or 'azadi.db')
+    else:
+        raise ValueError(f"Unknown storage backend: {backend}")
+    migrate_from_json(storage, users_file, configs_file, default_configs)
+    return storage
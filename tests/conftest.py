@@ -0,0 +1,19 @@
+import os
+import sys
+import importlib
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def bot(tmp_path_factory):
+    # main.py opens its storage in the working directory at import time.
+    previous = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('bot'))
+    try:
+        yield importlib.import_module('main')
+    finally:
+        os.chdir(previous)
@@ -0,0 +1,54 @@
+import json
+import base64
+
+import pytest
+
+from sharelinks import b64encode, parse_config_url
+
+VMESS = 'vmess://' + b64encode(json.dumps({'add': 'de.example.com', 'port': '443', 'id': 'u', 'ps': 'old', 'tls': 'tls'}))
+CONFIGS = {
+    'vl': {'name': 'Fast 🇳🇱', 'config': 'vless://u@nl.example.com:443?security=tls&sni=nl.example.com#old'},
+    'tr': {'name': 'Fast 🇳🇱', 'config': 'trojan://pw@fr.example.com:8443'},
+    'vm': {'name': 'VMess 🇩🇪', 'config': VMESS},
+    'ss': {'name': 'SS', 'config': 'ss://' + b64encode('aes-256-gcm:pw') + '@ss.example.com:8388'},
+    'wg': {'name': 'WG', 'config': 'wireguard://key@wg.example.com:51820'},
+}
+
+
+@pytest.fixture
+def configs(bot):
+    bot.PARSED.sync(CONFIGS)
+    return CONFIGS
+
+
+def test_base64_feed_names_every_link(bot, configs):
+    links = base64.b64decode(bot.render_base64_feed(configs)).decode('utf-8').split('\n')
+    names = [parse_config_url(link).link_name for link in links[:4]]
+    # Duplicate names get the config id appended, and vmess keeps its body decodable.
+    assert names == ['Fast 🇳🇱', 'Fast 🇳🇱 (tr)', 'VMess 🇩🇪', 'SS']
+    assert links[4] == 'wireguard://key@wg.example.com:51820#WG'
+    assert links[0] == 'vless://u@nl.example.com:443?security=tls&sni=nl.example.com#Fast%20%F0%9F%87%B3%F0%9F%87%B1'
+    assert '#' not in links[2] and parse_config_url(links[2]).host == 'de.example.com'
+
+
+def test_clash_feed(bot, configs):
+    lines = bot.render_clash_feed(configs).decode('utf-8').splitlines()
+    proxies = [json.loads(line[4:]) for line in lines[1:lines.index('proxy-groups:')]]
+    assert [(p['name'], p['type'], p['server'], p['port']) for p in proxies] == [
+        ('Fast 🇳🇱', 'vless', 'nl.example.com', 443),
+        ('Fast 🇳🇱 (tr)', 'trojan', 'fr.example.com', 8443),
+        ('VMess 🇩🇪', 'vmess', 'de.example.com', 443),
+        ('SS', 'ss', 'ss.example.com', 8388),
+    ]
+    assert proxies[3]['cipher'] == 'aes-256-gcm' and proxies[3]['password'] == 'pw'
+    select = json.loads(lines[lines.index('proxy-groups:') + 1][4:])
+    assert select['proxies'] == ['auto'] + [p['name'] for p in proxies]
+
+
+def test_singbox_feed(bot, configs):
+    outbounds = json.loads(bot.render_singbox_feed(configs))['outbounds']
+    tags = ['Fast 🇳🇱', 'Fast 🇳🇱 (tr)', 'VMess 🇩🇪', 'SS']
+    assert outbounds[0] == {'type': 'selector', 'tag': bot.SUBSCRIPTION_PROFILE_NAME, 'outbounds': ['auto'] + tags}
+    assert outbounds[1] == {'type': 'urltest', 'tag': 'auto', 'outbounds': tags}
+    assert [o['type'] for o in outbounds[2:]] == ['vless', 'trojan', 'vmess', 'shadowsocks', 'direct']
+    assert outbounds[5]['method'] == 'aes-256-gcm'
@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+
+def test_malformed_hostname_is_unreachable(bot):
+    assert asyncio.run(bot.probe_server('us1..example.com', 443, timeout=1)) is None
+
+
+def test_malformed_hostname_does_not_abort_health_round(bot):
+    async def scenario():
+        server = await asyncio.start_server(lambda reader, writer: writer.close(), '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        bot.CONFIGS.clear()
+        bot.CONFIGS.update({
+            'typo': {'name': 'Typo', 'config': f'vless://u@us1..example.com:{port}?security=tls'},
+            'ok': {'name': 'OK', 'config': f'vless://u@127.0.0.1:{port}?security=tls'},
+        })
+        bot.PARSED.sync(bot.CONFIGS)
+        monitor = bot.HealthMonitor()
+        try:
+            await monitor.check_now()
+        finally:
+            server.close()
+        return monitor
+
+    monitor = asyncio.run(scenario())
+    assert monitor.last_checked is not None
+    assert monitor.get('typo').last is None
+    assert monitor.get('ok').last is not None
+
+
+def test_malformed_hostname_is_negatively_cached():
+    from resolver import DnsResolver, ResolveError
+
+    async def scenario():
+        resolver = DnsResolver()
+        for _ in range(2):
+            with pytest.raises(ResolveError):
+                await resolver.resolve('us1..example.com')
+        return resolver
+
+    resolver = asyncio.run(scenario())
+    assert resolver.lookups['failure'] == 1
+    assert resolver.lookups['negative'] == 1
+
+
+def test_abandoned_lookup_failure_is_retrieved(monkeypatch):
+    import gc
+    from resolver import DnsResolver
+
+    async def slow_failure(self, host):
+        await asyncio.sleep(0.2)
+        raise OSError('no answer')
+
+    monkeypatch.setattr(DnsResolver, '_query', slow_failure)
+
+    async def scenario():
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context['message']))
+        resolver = DnsResolver(timeout=1)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(resolver.resolve('slow.example.com'), 0.05)
+        await asyncio.sleep(0.3)
+        gc.collect()
+        return resolver, errors
+
+    resolver, errors = asyncio.run(scenario())
+    assert resolver.lookups['failure'] == 1
+    assert errors == []
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+
+class FakeQuery:
+    def __init__(self, data, user_id):
+        self.data = data
+        self.from_user = type('User', (), {'id': user_id})()
+        self.answers = []
+
+    async def answer(self, *args, **kwargs):
+        if self.answers:
+            raise AssertionError("query answered twice")
+        self.answers.append(args)
+
+
+@pytest.mark.parametrize('data, name, arg', [
+    ('copy_sublink', 'copy_sublink', None),
+    ('copy_us_vless_1', 'copy_', 'us_vless_1'),
+    ('admin_remove_config', 'admin_remove_config', None),
+    ('admin_remove_us_vless_1', 'admin_remove_', 'us_vless_1'),
+    ('bcast_cancel', 'bcast_cancel', None),
+    ('bcast_active7', 'bcast_', 'active7'),
+    ('faq_3', 'faq_', '3'),
+])
+def test_exact_keys_win_then_longest_prefix(bot, data, name, arg):
+    route, raw_arg = bot.ROUTER.resolve(data)
+    assert route.name == name
+    assert raw_arg == arg
+
+
+def test_unknown_data_resolves_to_nothing(bot):
+    assert bot.ROUTER.resolve('no_such_button') == (None, None)
+
+
+def dispatch(bot, router, data, user_id=None):
+    query = FakeQuery(data, bot.ADMIN_ID if user_id is None else user_id)
+    asyncio.run(router.dispatch(query, None))
+    return query
+
+
+def test_each_query_is_answered_once(bot):
+    calls = []
+
+    async def plain(query):
+        calls.append('plain')
+
+    async def answers_itself(query):
+        calls.append('self')
+        await query.answer("done")
+
+    async def forgets_to_answer(query):
+        calls.append('forgot')
+
+    async def item(query, index):
+        calls.append(index)
+
+    router = bot.CallbackRouter()
+    router.exact('plain', plain)
+    router.exact('self', answers_itself, answers=True)
+    router.exact('forgot', forgets_to_answer, answers=True)
+    router.prefix('item_', item, parse=int, answers=True)
+    router.exact('admin', plain, admin_only=True)
+
+    assert dispatch(bot, router, 'plain').answers == [()]
+    assert dispatch(bot, router, 'self').answers == [("done",)]
+    assert dispatch(bot, router, 'forgot').answers == [()]
+    assert dispatch(bot, router, 'item_7').answers == [()]
+    assert dispatch(bot, router, 'item_x').answers == [()]
+    assert dispatch(bot, router, 'unknown').answers == [()]
+    denied = dispatch(bot, router, 'admin', user_id=bot.ADMIN_ID + 1)
+    assert len(denied.answers) == 1 and denied.answers[0][0].startswith("⛔")
+    assert calls == ['plain', 'self', 'forgot', 7]
+
+
+def test_route_answers_even_when_handler_fails(bot):
+    async def broken(query):
+        raise RuntimeError("boom")
+
+    router = bot.CallbackRouter()
+    router.exact('broken', broken, answers=True)
+    query = FakeQuery('broken', bot.ADMIN_ID)
+    with pytest.raises(RuntimeError):
+        asyncio.run(router.dispatch(query, None))
+    assert query.answers == [()]
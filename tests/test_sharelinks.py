@@ -0,0 +1,112 @@
+import json
+
+import pytest
+
+from sharelinks import ConfigIndex, b64encode, parse_config_url, with_link_name
+
+UUID = '826f524a-cea1-4e44-9b49-3381d13b7593'
+
+
+def vmess_link(**fields):
+    data = {'v': '2', 'ps': 'DE 🇩🇪', 'add': 'de.example.com', 'port': '8443', 'id': UUID, 'aid': '0',
+            'net': 'ws', 'path': '/ws', 'host': 'cdn.example.com', 'tls': 'tls', **fields}
+    return 'vmess://' + b64encode(json.dumps(data))
+
+
+def ssr_link(remarks='old'):
+    main = f"ssr.example.com:8388:origin:aes-256-cfb:plain:{b64encode('secret', urlsafe=True)}"
+    return 'ssr://' + b64encode(f"{main}/?obfsparam=&remarks={b64encode(remarks, urlsafe=True)}", urlsafe=True)
+
+
+def test_vmess():
+    p = parse_config_url(vmess_link())
+    assert (p.protocol, p.host, p.port, p.uuid) == ('vmess', 'de.example.com', 8443, UUID)
+    assert (p.transport, p.path, p.ws_host, p.tls, p.sni) == ('ws', '/ws', 'cdn.example.com', True, 'cdn.example.com')
+    assert p.country == 'DE'
+
+
+def test_vless_reality():
+    p = parse_config_url(f'vless://{UUID}@1.2.3.4:443?security=reality&pbk=KEY&sid=ab&sni=www.example.com'
+                         '&fp=chrome&flow=xtls-rprx-vision&type=tcp#NL%20%F0%9F%87%B3%F0%9F%87%B1')
+    assert (p.protocol, p.host, p.port, p.uuid) == ('vless', '1.2.3.4', 443, UUID)
+    assert p.reality and p.tls and (p.public_key, p.short_id) == ('KEY', 'ab')
+    assert (p.sni, p.fingerprint, p.flow) == ('www.example.com', 'chrome', 'xtls-rprx-vision')
+    assert p.country == 'NL'
+
+
+def test_trojan_defaults_to_tls():
+    p = parse_config_url('trojan://p%40ss@[2001:db8::1]:8443?type=grpc&serviceName=svc')
+    assert (p.protocol, p.host, p.port, p.password) == ('trojan', '2001:db8::1', 8443, 'p@ss')
+    assert p.tls and (p.transport, p.service_name) == ('grpc', 'svc')
+
+
+@pytest.mark.parametrize('url', [
+    'ss://' + b64encode('aes-256-gcm:secret') + '@ss.example.com:8388#name',
+    'ss://aes-256-gcm:secret@ss.example.com:8388/?plugin=none#name',
+    'ss://' + b64encode('aes-256-gcm:secret') + '@[ss.example.com]:8388',
+])
+def test_ss_sip002(url):
+    p = parse_config_url(url)
+    assert (p.protocol, p.host, p.port, p.cipher, p.password) == ('ss', 'ss.example.com', 8388, 'aes-256-gcm', 'secret')
+
+
+def test_ss_legacy_password_with_separators():
+    p = parse_config_url('ss://' + b64encode('chacha20-ietf-poly1305:a/b?c@d:e@ss.example.com:8388') + '#old')
+    assert (p.host, p.port, p.cipher, p.password, p.link_name) == (
+        'ss.example.com', 8388, 'chacha20-ietf-poly1305', 'a/b?c@d:e', 'old')
+
+
+def test_ssr():
+    p = parse_config_url(ssr_link('JP 🇯🇵') + '#ignored')
+    assert (p.protocol, p.host, p.port, p.cipher, p.obfs, p.password) == (
+        'ssr', 'ssr.example.com', 8388, 'aes-256-cfb', 'plain', 'secret')
+    assert p.link_name == 'JP 🇯🇵' and p.country == 'JP'
+
+
+@pytest.mark.parametrize('url, protocol', [
+    ('hy2://pw@hy.example.com:443?sni=hy.example.com&obfs=salamander&obfs-password=x', 'hysteria2'),
+    ('hysteria2://pw@hy.example.com:443?insecure=1', 'hysteria2'),
+    ('hysteria://pw@hy.example.com:443', 'hysteria'),
+])
+def test_hysteria(url, protocol):
+    p = parse_config_url(url)
+    assert (p.protocol, p.host, p.port, p.password, p.tls) == (protocol, 'hy.example.com', 443, 'pw', True)
+
+
+def test_tuic():
+    p = parse_config_url(f'tuic://{UUID}:pw@tuic.example.com:443?alpn=h3')
+    assert (p.protocol, p.uuid, p.password, p.alpn) == ('tuic', UUID, 'pw', 'h3')
+
+
+@pytest.mark.parametrize('url', ['vless://uuid@:443', 'vmess://not-base64!', 'ss://', 'wireguard://x@h:1'])
+def test_malformed_or_unknown_links_are_not_known(url):
+    assert not parse_config_url(url).known
+
+
+def test_name_argument_sets_country():
+    assert parse_config_url('trojan://p@h.example.com:443', 'FR 🇫🇷').country == 'FR'
+
+
+def test_with_link_name_keeps_base64_bodies_decodable():
+    vmess = with_link_name(vmess_link(), 'New 🇬🇧')
+    assert '#' not in vmess
+    assert parse_config_url(vmess).link_name == 'New 🇬🇧'
+    assert parse_config_url(vmess).host == 'de.example.com'
+
+    ssr = with_link_name(ssr_link(), 'New 🇬🇧')
+    assert '#' not in ssr
+    assert parse_config_url(ssr).link_name == 'New 🇬🇧'
+    assert parse_config_url(ssr).password == 'secret'
+
+    assert with_link_name('trojan://p@h:443#old', 'a b') == 'trojan://p@h:443#a%20b'
+    assert with_link_name('vmess://broken#old', 'x') == 'vmess://broken#old'
+
+
+def test_config_index_reparses_only_changed_entries():
+    index = ConfigIndex()
+    cfg = {'name': 'A', 'config': 'trojan://p@a.example.com:443'}
+    first = index.get('a', cfg)
+    assert index.get('a', dict(cfg)) is first
+    assert index.get('a', dict(cfg, config='trojan://p@b.example.com:443')).host == 'b.example.com'
+    index.sync({})
+    assert index.get('a', cfg) is not first
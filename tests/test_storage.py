@@ -0,0 +1,111 @@
+import json
+
+import pytest
+
+from storage import JsonStorage, JournalStorage, SqliteStorage, open_storage
+
+DEFAULT_CONFIGS = {'a': {'name': 'A', 'config': 'vless://u@a.example.com:443'}}
+
+
+def open_backend(backend, tmp_path):
+    if backend == 'json':
+        return JsonStorage(str(tmp_path / 'users.json'), str(tmp_path / 'configs.json'), {})
+    if backend == 'journal':
+        return JournalStorage(str(tmp_path / 'azadi.journal'), compact_every=3)
+    return SqliteStorage(str(tmp_path / 'azadi.db'))
+
+
+@pytest.mark.parametrize('backend', ['json', 'journal', 'sqlite'])
+def test_round_trip(tmp_path, backend):
+    storage = open_backend(backend, tmp_path)
+    storage.add_users([3, 1, 2])
+    storage.remove_users([2])
+    storage.touch_users({1: (1000, 'fa')})
+    storage.put_config('b', {'name': 'B', 'config': 'trojan://p@b:443'})
+    storage.put_configs({'a': {'name': 'A', 'config': 'vless://u@a:443'}, 'c': {'name': 'C', 'config': 'ss://x'}})
+    storage.put_config('b', {'name': 'B2', 'config': 'trojan://p@b:443'})
+    storage.delete_config('c')
+    storage.set_meta('broadcast', {'cursor': 5})
+    storage.close()
+
+    storage = open_backend(backend, tmp_path)
+    assert storage.load_users() == {1, 3}
+    configs = storage.load_configs()
+    assert list(configs) == ['b', 'a']
+    assert configs['b']['name'] == 'B2'
+    assert storage.get_meta('broadcast') == {'cursor': 5}
+    assert storage.get_meta('missing', 'default') == 'default'
+    batches = list(storage.iter_users(batch_size=1))
+    assert [[row[0] for row in batch] for batch in batches] == [[1], [3]]
+    assert batches[0][0][2:] == (1000, 'fa')
+    assert batches[1][0][1] is not None
+    storage.close()
+
+
+@pytest.mark.parametrize('tail', ['{"op": "users+", "ids": [3', '{"op": "users+", "ids": [3], "at": 1}'])
+def test_journal_recovers_from_torn_tail(tmp_path, tail):
+    path = str(tmp_path / 'azadi.journal')
+    storage = JournalStorage(path)
+    storage.add_users([1, 2])
+    storage._fh.close()
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(tail)
+
+    storage = JournalStorage(path)
+    storage.add_users([4])
+    storage._fh.close()
+
+    # A whole entry that only lost its newline is kept; a torn one is dropped.
+    expected = {1, 2, 3, 4} if tail.endswith('}') else {1, 2, 4}
+    assert JournalStorage(path).load_users() == expected
+
+
+@pytest.mark.parametrize('backend', ['journal', 'sqlite'])
+def test_migrates_json_files_once(tmp_path, backend):
+    users_file = str(tmp_path / 'users.json')
+    configs_file = str(tmp_path / 'configs.json')
+    with open(users_file, 'w', encoding='utf-8') as f:
+        json.dump([5, 6], f)
+    with open(configs_file, 'w', encoding='utf-8') as f:
+        json.dump({'b': {'name': 'B', 'config': 'trojan://p@b.example.com:443'}}, f)
+    path = str(tmp_path / backend)
+
+    storage = open_storage(backend, path, users_file, configs_file, DEFAULT_CONFIGS)
+    assert storage.load_users() == {5, 6}
+    assert list(storage.load_configs()) == ['b']
+    storage.remove_users([5])
+    storage.delete_config('b')
+    storage.close()
+
+    # The JSON files are still there, but a second start must not import them again.
+    storage = open_storage(backend, path, users_file, configs_file, DEFAULT_CONFIGS)
+    assert storage.load_users() == {6}
+    assert storage.load_configs() == {}
+    storage.close()
+
+
+def test_migration_without_json_files_seeds_default_configs(tmp_path):
+    storage = SqliteStorage(str(tmp_path / 'azadi.db'))
+    storage.close()
+    storage = open_storage('sqlite', str(tmp_path / 'azadi.db'), str(tmp_path / 'users.json'),
+                           str(tmp_path / 'configs.json'), DEFAULT_CONFIGS)
+    assert storage.load_users() == set()
+    assert storage.load_configs() == DEFAULT_CONFIGS
+    storage.close()
+
+
+def test_json_last_seen_is_logged_not_rewritten(tmp_path):
+    def open_json():
+        return JsonStorage(str(tmp_path / 'users.json'), str(tmp_path / 'configs.json'), DEFAULT_CONFIGS)
+
+    storage = open_json()
+    storage.add_users([1, 2])
+    activity = (tmp_path / 'users_activity.json').read_text(encoding='utf-8')
+    storage.touch_users({1: (1000, 'fa'), 3: (1000, 'en')})
+    storage.touch_users({1: (2000, None)})
+    assert (tmp_path / 'users_activity.json').read_text(encoding='utf-8') == activity
+
+    rows = {row[0]: row for batch in open_json().iter_users() for row in batch}
+    assert rows[1][2:] == (2000, 'fa')
+    assert rows[2][2:] == (None, None)
+    assert 3 not in rows